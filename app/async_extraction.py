@@ -0,0 +1,140 @@
+import asyncio
+import os
+import queue
+import threading
+
+from app.common import get_int_env
+
+_PAGE = "page"
+_DONE = "done"
+_FAILED = "failed"
+
+_extractor = None
+_extractor_lock = threading.Lock()
+
+
+def get_es_concurrency() -> int:
+    return max(1, get_int_env("ES_CONCURRENCY", 4))
+
+
+def get_async_es_client():
+    # Needs the optional aiohttp transport: pip install ".[async]"
+    from elasticsearch import AsyncElasticsearch
+
+    es_host = os.getenv("ES_HOST", "http://localhost:19200")
+    es_user = os.getenv("ES_USERNAME", "")
+    es_pass = os.getenv("ES_PASSWORD", "")
+
+    if es_user and es_pass:
+        return AsyncElasticsearch(
+            es_host,
+            basic_auth=(es_user, es_pass),
+        )
+
+    return AsyncElasticsearch(es_host)
+
+
+class AsyncExtractor:
+    """Runs AsyncElasticsearch streams on a background event loop and hands their pages to sync consumers."""
+
+    def __init__(self, concurrency=None, max_pending_pages=4):
+        self.concurrency = concurrency or get_es_concurrency()
+        self.max_pending_pages = max_pending_pages
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+
+    async def _setup(self):
+        self.es = get_async_es_client()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def _put(self, pages, item):
+        # Poll instead of blocking so a full queue never stalls the event loop and tasks stay cancellable
+        while True:
+            try:
+                pages.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.05)
+
+    async def _run(self, pages, coro):
+        try:
+            await coro
+        except Exception as e:
+            await self._put(pages, (_FAILED, e))
+            return
+        await self._put(pages, (_DONE, None))
+
+    def _start(self, make_coro):
+        pages = queue.Queue(maxsize=self.max_pending_pages)
+        future = asyncio.run_coroutine_threadsafe(self._run(pages, make_coro(pages)), self.loop)
+        return self._drain(pages, future)
+
+    def _drain(self, pages, future):
+        try:
+            while True:
+                kind, payload = pages.get()
+                if kind == _PAGE:
+                    yield payload
+                elif kind == _DONE:
+                    return
+                else:
+                    raise payload
+        finally:
+            future.cancel()
+
+    async def _scroll_slice(self, pages, index, query, slice_id, slices):
+        body = dict(query)
+        if slices > 1:
+            body["slice"] = {"id": slice_id, "max": slices}
+
+        async with self.semaphore:
+            resp = await self.es.search(index=index, body=body, scroll="2m")
+        scroll_id = resp["_scroll_id"]
+        hits = resp["hits"]["hits"]
+
+        try:
+            while hits:
+                await self._put(pages, (_PAGE, hits))
+                async with self.semaphore:
+                    resp = await self.es.scroll(scroll_id=scroll_id, scroll="2m")
+                scroll_id = resp["_scroll_id"]
+                hits = resp["hits"]["hits"]
+        finally:
+            try:
+                await self.es.clear_scroll(scroll_id=scroll_id)
+            except Exception:
+                pass
+
+    async def _scroll_index(self, pages, index, query, slices):
+        await asyncio.gather(*(
+            self._scroll_slice(pages, index, query, slice_id, slices)
+            for slice_id in range(slices)
+        ))
+
+    def index_pages(self, index, query=None, size=1000, slices=1):
+        if query is None:
+            query = {"query": {"match_all": {}}, "size": size}
+        return self._start(lambda pages: self._scroll_index(pages, index, query, slices))
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.es.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def get_async_extractor():
+    global _extractor
+    with _extractor_lock:
+        if _extractor is None:
+            _extractor = AsyncExtractor()
+        return _extractor
+
+
+def close_async_extractor():
+    global _extractor
+    with _extractor_lock:
+        if _extractor is not None:
+            _extractor.close()
+            _extractor = None
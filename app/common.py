@@ -1,12 +1,23 @@
+import io
+import itertools
+import json
 import os
 import psycopg2
+import queue
+import re
 import sqlite3
+import tempfile
+import threading
+import time
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ, TRANSACTION_STATUS_INERROR
 from elasticsearch import Elasticsearch
 import os
 from pathlib import Path
 BASE_DIR = Path(__file__).parent
 MAIN_DB_PATH = BASE_DIR / "data" / "export_data.sqlite"
 MAIN_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+SNAPSHOT_DIR = Path(os.getenv("ES_SNAPSHOT_DIR", MAIN_DB_PATH.parent / "snapshots"))
+SNAPSHOT_MANIFEST_PATH = SNAPSHOT_DIR / "manifest.json"
 
 ROLE_FIELD_TO_ROLE_NAME = {
     "person_subject": "Subject",
@@ -64,37 +75,456 @@ def execute_with_normalization(cursor, query, params=None):
     return cursor
 
 
-def get_db_connection(db_path=MAIN_DB_PATH):
-    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+def get_bool_env(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in {"1", "true", "yes", "on"}
+
+
+def get_int_env(name, default):
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def get_sqlite_bulk_load() -> bool:
+    return get_bool_env("SQLITE_BULK_LOAD", True)
+
+
+def get_deferred_foreign_keys() -> bool:
+    return get_bool_env("SQLITE_DEFERRED_FOREIGN_KEYS", False)
+
+
+def get_fk_violation_action() -> str:
+    action = os.getenv("SQLITE_FK_VIOLATIONS", "prune").lower()
+    return action if action in {"report", "prune"} else "prune"
+
+
+def apply_bulk_load_profile(cursor):
+    # The export is rebuilt from scratch on failure, so durability is traded for write speed
+    execute_with_normalization(cursor, "PRAGMA synchronous = OFF;")
+    execute_with_normalization(cursor, f"PRAGMA cache_size = -{get_int_env('SQLITE_CACHE_SIZE_MB', 512) * 1024};")
+    execute_with_normalization(cursor, "PRAGMA temp_store = MEMORY;")
+    execute_with_normalization(cursor, f"PRAGMA mmap_size = {get_int_env('SQLITE_MMAP_SIZE_MB', 1024) * 1024 * 1024};")
+
+
+SQLITE_BUILD_MODES = {"direct", "tmpfs", "memory"}
+MEMORY_DB_URI = "file:dbbe_export_build?mode=memory&cache=shared"
+_memory_keeper = None
+
+
+def get_sqlite_build_mode() -> str:
+    mode = os.getenv("SQLITE_BUILD_MODE", "direct").lower()
+    return mode if mode in SQLITE_BUILD_MODES else "direct"
+
+
+def get_staging_dir() -> Path:
+    default = "/dev/shm" if Path("/dev/shm").is_dir() else tempfile.gettempdir()
+    return Path(os.getenv("SQLITE_STAGING_DIR", default))
+
+
+def get_build_db_path():
+    mode = get_sqlite_build_mode()
+    if mode == "memory":
+        return MEMORY_DB_URI
+    if mode == "tmpfs":
+        return get_staging_dir() / MAIN_DB_PATH.name
+    return MAIN_DB_PATH
+
+
+def build_database_exists() -> bool:
+    db_path = get_build_db_path()
+    return db_path != MEMORY_DB_URI and Path(db_path).exists()
+
+
+def connect_sqlite(db_path, **kwargs):
+    global _memory_keeper
+    if db_path == MEMORY_DB_URI:
+        # A shared in-memory database lives as long as one connection to it is open
+        if _memory_keeper is None:
+            _memory_keeper = sqlite3.connect(MEMORY_DB_URI, uri=True, check_same_thread=False)
+        return sqlite3.connect(MEMORY_DB_URI, uri=True, **kwargs)
+    return sqlite3.connect(db_path, **kwargs)
+
+
+DEFERRED_REFERENCES = set()
+
+
+def defer_references(table, parent):
+    # Only references whose per-row existence probe was skipped are pruned by check_foreign_keys
+    DEFERRED_REFERENCES.add((table, parent))
+
+
+def load_ids(cursor, table):
+    # One set lookup per reference instead of a SELECT round trip per row
+    return {str(row[0]) for row in execute_with_normalization(cursor, f'SELECT id FROM "{table}"').fetchall()}
+
+
+def set_foreign_keys(cursor, enabled):
+    # With deferred foreign keys they stay off until check_foreign_keys runs at the end of the build
+    if get_deferred_foreign_keys():
+        return
+    execute_with_normalization(cursor, f"PRAGMA foreign_keys = {'ON' if enabled else 'OFF'};")
+
+
+def get_db_connection(db_path=None):
+    # The step's SQLiteWriter thread shares this connection
+    conn = connect_sqlite(db_path or get_build_db_path(), timeout=60, isolation_level=None, check_same_thread=False)
     cursor = conn.cursor()
+    bulk_load = get_sqlite_bulk_load()
+    if bulk_load:
+        # page_size only takes effect before the first table exists and before switching to WAL
+        execute_with_normalization(cursor, f"PRAGMA page_size = {get_int_env('SQLITE_PAGE_SIZE', 8192)};")
+        execute_with_normalization(cursor, "PRAGMA locking_mode = EXCLUSIVE;")
     execute_with_normalization(cursor, "PRAGMA journal_mode = WAL;")
     execute_with_normalization(cursor, "PRAGMA busy_timeout = 60000;")
-    execute_with_normalization(cursor, "PRAGMA foreign_keys = ON;")
+    set_foreign_keys(cursor, True)
+    if bulk_load:
+        apply_bulk_load_profile(cursor)
     return conn, cursor
 
-def get_postgres_connection():
+
+def finalize_database(db_path=None):
+    # Fold the WAL back in and store a rollback journal in the file header so the published file stands alone
+    db_path = db_path or get_build_db_path()
+    conn = connect_sqlite(db_path, timeout=60, isolation_level=None)
+    cursor = conn.cursor()
+    execute_with_normalization(cursor, "PRAGMA wal_checkpoint(TRUNCATE);")
+    execute_with_normalization(cursor, "PRAGMA journal_mode = DELETE;")
+    execute_with_normalization(cursor, "PRAGMA optimize;")
+    result = execute_with_normalization(cursor, "PRAGMA quick_check;").fetchone()[0]
+    conn.close()
+    if result != "ok":
+        raise RuntimeError(f"SQLite quick_check failed for {db_path}: {result}")
+    print(f"Finalized {db_path}")
+
+
+def check_foreign_keys(db_path=None):
+    if not get_deferred_foreign_keys():
+        return
+
+    conn = connect_sqlite(db_path or get_build_db_path(), timeout=60, isolation_level=None)
+    cursor = conn.cursor()
+    violations = {}
+    for table, rowid, parent, _ in execute_with_normalization(cursor, "PRAGMA foreign_key_check;").fetchall():
+        violations.setdefault((table, parent), set()).add(rowid)
+
+    prune = get_fk_violation_action() == "prune"
+    pruned = 0
+    execute_with_normalization(cursor, "BEGIN")
+    for (table, parent), rowids in sorted(violations.items()):
+        if prune and (table, parent) in DEFERRED_REFERENCES:
+            cursor.executemany(f'DELETE FROM "{table}" WHERE rowid = ?', [(rowid,) for rowid in rowids])
+            pruned += len(rowids)
+            print(f"Pruned {len(rowids)} rows from {table} referencing missing {parent} rows")
+        else:
+            print(f"{len(rowids)} rows in {table} reference missing {parent} rows")
+    execute_with_normalization(cursor, "COMMIT")
+    conn.close()
+    print(f"Foreign key check completed: {sum(len(r) for r in violations.values())} dangling references, {pruned} pruned")
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def publish_database(target=MAIN_DB_PATH):
+    # Copy the staged build into place so a failed run never leaves a half-built export behind
+    global _memory_keeper
+    db_path = get_build_db_path()
+    if db_path == target:
+        return
+
+    tmp_path = target.with_name(target.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    conn = connect_sqlite(db_path, timeout=60, isolation_level=None)
+    execute_with_normalization(conn.cursor(), "VACUUM INTO ?;", (str(tmp_path),))
+    conn.close()
+    fsync_path(tmp_path)
+
+    # A leftover WAL from an earlier direct build must not be replayed into the new file
+    for suffix in ("-wal", "-shm"):
+        Path(str(target) + suffix).unlink(missing_ok=True)
+    os.replace(tmp_path, target)
+    fsync_path(target.parent)
+
+    if db_path == MEMORY_DB_URI:
+        if _memory_keeper is not None:
+            _memory_keeper.close()
+            _memory_keeper = None
+    else:
+        for suffix in ("", "-wal", "-shm"):
+            Path(str(db_path) + suffix).unlink(missing_ok=True)
+    print(f"Published {db_path} to {target}")
+
+def get_consistent_snapshot() -> bool:
+    return get_bool_env("PG_CONSISTENT_SNAPSHOT", True)
+
+
+def connect_postgres():
     pg_connection_string = os.getenv("PG_CONNECTION_STRING")
 
     if pg_connection_string:
         ### For some reason this is the only way we can connect via Nomad. Pg_user and password combination gives 'incorrect password' like errors.
-        pg_conn = psycopg2.connect(pg_connection_string)
-    else:
-        pg_host = os.getenv("PG_HOST", "localhost")
-        pg_port = os.getenv("PG_PORT", 15432)
-        pg_user = os.getenv("PG_USER", "db_dbbe_dev")
-        pg_password = os.getenv("PG_PASSWORD", "db_dbbe_dev")
-        pg_db = os.getenv("PG_DB", "db_dbbe_dev")
-        pg_conn = psycopg2.connect(
-            host=pg_host,
-            port=pg_port,
-            dbname=pg_db,
-            user=pg_user,
-            password=pg_password
-        )
+        return psycopg2.connect(pg_connection_string)
+
+    pg_host = os.getenv("PG_HOST", "localhost")
+    pg_port = os.getenv("PG_PORT", 15432)
+    pg_user = os.getenv("PG_USER", "db_dbbe_dev")
+    pg_password = os.getenv("PG_PASSWORD", "db_dbbe_dev")
+    pg_db = os.getenv("PG_DB", "db_dbbe_dev")
+    return psycopg2.connect(
+        host=pg_host,
+        port=pg_port,
+        dbname=pg_db,
+        user=pg_user,
+        password=pg_password
+    )
+
+
+class PostgresPool:
+    """Hands out Postgres connections that all read from one exported run-wide snapshot."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+        self.connections = []
+        self.snapshot_id = None
+        self.exporter = None
+
+    def _open(self):
+        conn = connect_postgres()
+        if not get_consistent_snapshot():
+            return conn
+
+        conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        cursor = conn.cursor()
+        if self.snapshot_id is None:
+            cursor.execute("SELECT pg_export_snapshot()")
+            self.snapshot_id = cursor.fetchone()[0]
+            self.exporter = conn
+            print(f"Reading Postgres from snapshot {self.snapshot_id}")
+        else:
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", (self.snapshot_id,))
+        cursor.close()
+        return conn
+
+    def _reexport(self):
+        # The snapshot dies with the exporting transaction; an idle connection that imported it can export it again
+        self.snapshot_id = None
+        self.exporter = None
+        for conn in list(self.idle):
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT pg_export_snapshot()")
+                snapshot_id = cursor.fetchone()[0]
+                cursor.close()
+            except psycopg2.Error:
+                self.idle.remove(conn)
+                self.connections.remove(conn)
+                conn.close()
+                continue
+            self.snapshot_id = snapshot_id
+            self.exporter = conn
+            print(f"Re-exported Postgres snapshot as {snapshot_id}")
+            return
+        print("Postgres snapshot connection was lost; new connections start from a fresh snapshot")
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            conn = self._open()
+            self.connections.append(conn)
+            return conn
+
+    def release(self, conn):
+        with self.lock:
+            if conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+                # An aborted transaction can't serve further reads; drop it and let the next acquire reconnect
+                self.connections.remove(conn)
+                if not conn.closed:
+                    conn.close()
+                if conn is self.exporter:
+                    self._reexport()
+                return
+            if not get_consistent_snapshot():
+                conn.rollback()
+            self.idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                if not conn.closed:
+                    conn.close()
+            self.idle = []
+            self.connections = []
+            self.snapshot_id = None
+            self.exporter = None
+
+
+class PooledConnection:
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return self._conn.cursor(*args, **kwargs)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+POSTGRES_POOL = PostgresPool()
+
+
+def get_postgres_connection():
+    pg_conn = PooledConnection(POSTGRES_POOL, POSTGRES_POOL.acquire())
     pg_cursor = pg_conn.cursor()
     return pg_conn, pg_cursor
 
 
+def get_pg_itersize() -> int:
+    return max(1, get_int_env("PG_ITERSIZE", 2000))
+
+
+_STREAM_CURSOR_IDS = itertools.count()
+
+
+def stream_query(pg_conn, query, params=None, itersize=None):
+    # Named cursors are server-side: rows arrive itersize at a time instead of all at once
+    pg_cursor = pg_conn.cursor(name=f"stream_{next(_STREAM_CURSOR_IDS)}")
+    pg_cursor.itersize = itersize or get_pg_itersize()
+    pg_cursor.execute(query, params)
+    try:
+        yield from pg_cursor
+    finally:
+        pg_cursor.close()
+
+
+_COPY_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+_COPY_ESCAPE_RE = re.compile(r"\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)")
+
+
+def _unescape_copy_sequence(match):
+    seq = match.group(1)
+    if seq in _COPY_ESCAPES:
+        return _COPY_ESCAPES[seq]
+    if len(seq) > 1 and seq[0] == "x":
+        return chr(int(seq[1:], 16))
+    if seq[0] in "01234567":
+        return chr(int(seq, 8))
+    return seq
+
+
+def parse_copy_field(field):
+    if field == "\\N":
+        return None
+    if "\\" not in field:
+        return field
+    return _COPY_ESCAPE_RE.sub(_unescape_copy_sequence, field)
+
+
+class _CopyCancelled(Exception):
+    pass
+
+
+class CopyRowWriter(io.TextIOBase):
+    # psycopg2 decodes COPY data for text files, so every write is a str with one or more rows
+    def __init__(self, on_row):
+        self.on_row = on_row
+        self.pending = ""
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        lines = (self.pending + data).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self.on_row(tuple(parse_copy_field(field) for field in line.split("\t")))
+        return len(data)
+
+
+def copy_query(pg_conn, query, batch_size=None):
+    # Values arrive as text (booleans as 't'/'f'), NULL as None
+    batch_size = batch_size or get_pg_itersize()
+    batches = queue.Queue(maxsize=4)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read():
+        batch = []
+
+        def on_row(row):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                if not put(("rows", list(batch))):
+                    raise _CopyCancelled()
+                batch.clear()
+
+        try:
+            with pg_conn.cursor() as pg_cursor:
+                pg_cursor.copy_expert(f"COPY ({query}) TO STDOUT", CopyRowWriter(on_row))
+        except _CopyCancelled:
+            return
+        except Exception as e:
+            put(("failed", e))
+            return
+        if batch:
+            put(("rows", batch))
+        put(("done", None))
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            kind, payload = batches.get()
+            if kind == "rows":
+                yield payload
+            elif kind == "done":
+                return
+            else:
+                raise payload
+    finally:
+        stop.set()
+
+
+def copy_into_sqlite(pg_conn, query, cursor, insert_query, transform=None, batch_size=None):
+    writer = BatchWriter(cursor, batch_size)
+    count = 0
+    for rows in copy_query(pg_conn, query, batch_size):
+        if transform is not None:
+            rows = [transform(*row) for row in rows]
+        writer.add_many(insert_query, rows)
+        count += len(rows)
+    writer.flush()
+    return count
+
+
+def close_postgres_pool():
+    POSTGRES_POOL.close()
+
+
 def get_es_client():
     es_host = os.getenv("ES_HOST", "http://localhost:19200")
     es_user = os.getenv("ES_USERNAME", "")
@@ -109,21 +539,33 @@ def get_es_client():
 
     return Elasticsearch(es_host)
 
-def scroll_all(es, index, query=None, size=1000):
+def scroll_pages(es, index, query=None, size=1000):
     if query is None:
         query = {"query": {"match_all": {}}, "size": size}
 
     resp = es.search(index=index, body=query, scroll='2m')
     scroll_id = resp['_scroll_id']
     hits = resp['hits']['hits']
-    all_hits = hits[:]
 
-    while len(hits):
-        resp = es.scroll(scroll_id=scroll_id, scroll='2m')
-        hits = resp['hits']['hits']
-        all_hits.extend(hits)
+    try:
+        while len(hits):
+            yield hits
+            resp = es.scroll(scroll_id=scroll_id, scroll='2m')
+            scroll_id = resp['_scroll_id']
+            hits = resp['hits']['hits']
+    finally:
+        # Free the search context right away instead of leaving it on the cluster until it times out
+        try:
+            es.clear_scroll(scroll_id=scroll_id)
+        except Exception as e:
+            print(f"Could not clear scroll context for {index}: {e}")
 
 
+def scroll_all(es, index, query=None, size=1000):
+    all_hits = []
+    for hits in scroll_pages(es, index, query=query, size=size):
+        all_hits.extend(hits)
+
     return all_hits
 
 
@@ -134,74 +576,341 @@ def add_column_if_missing(cursor, table_name, column_name, column_type):
         execute_with_normalization(cursor, f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
 
 
-def get_role_id(cursor, role_name):
-    execute_with_normalization(cursor, "SELECT id FROM roles WHERE LOWER(name)=LOWER(?)", (role_name,))
-    row = cursor.fetchone()
-    return row[0] if row else None
+def preload_subject_keywords(pg_cursor):
+    pg_cursor.execute("""
+        SELECT identity, keyword
+        FROM data.keyword
+        WHERE is_subject = true
+    """)
+    return {str(row[0]): row[1] for row in pg_cursor.fetchall()}
 
-def get_or_create_role(cursor, role_name):
-    execute_with_normalization(cursor,
-        "SELECT id FROM roles WHERE name = ? LIMIT 1",
-                               (role_name,)
-                               )
-    row = cursor.fetchone()
-    if row:
-        return row[0]
-
-    pg_conn, pg_cursor = get_postgres_connection()
-
-    pg_cursor.execute(
-        """
-        SELECT idrole
-        FROM data.role
-        WHERE system_name = %s
-        LIMIT 1
-        """,
-        (role_name.lower(),)
-    )
-    pg_row = pg_cursor.fetchone()
 
-    if pg_row:
-        role_id = pg_row[0]
+class RoleRegistry:
+    """In-memory view of data.role and the SQLite roles table, loaded once per run."""
+
+    def __init__(self):
+        self.loaded = False
+
+    def load(self, cursor):
+        pg_conn, pg_cursor = get_postgres_connection()
+        pg_cursor.execute("SELECT idrole, system_name, name FROM data.role")
+        pg_rows = pg_cursor.fetchall()
+        pg_conn.close()
+
+        self.pg_ids_by_system_name = {system_name: idrole for idrole, system_name, _ in pg_rows}
+        self.pg_names_by_id = {idrole: name for idrole, _, name in pg_rows}
+        pg_max = max(self.pg_names_by_id, default=0)
+
+        execute_with_normalization(cursor, "SELECT id, name FROM roles")
+        self.known_ids = set()
+        self.ids_by_name = {}
+        self.ids_by_lower_name = {}
+        local_max = 0
+        for role_id, name in cursor.fetchall():
+            self.remember(int(role_id), name)
+            local_max = max(local_max, int(role_id))
+
+        # Roles unknown to Postgres get ids above every id used on either side
+        self.next_id = max(pg_max, local_max) + 1
+        self.loaded = True
+
+    def ensure_loaded(self, cursor):
+        if not self.loaded:
+            self.load(cursor)
+
+    def remember(self, role_id, name):
+        self.known_ids.add(role_id)
+        self.ids_by_name.setdefault(name, role_id)
+        self.ids_by_lower_name.setdefault(name.lower(), role_id)
+
+    def add(self, cursor, role_id, role_name):
         execute_with_normalization(cursor,
             "INSERT INTO roles (id, name) VALUES (?, ?)",
                                    (role_id, role_name)
                                    )
+        self.remember(role_id, role_name)
+        self.next_id = max(self.next_id, role_id + 1)
         return role_id
 
+    def get_role_id(self, cursor, role_name):
+        self.ensure_loaded(cursor)
+        return self.ids_by_lower_name.get(role_name.lower())
+
+    def get_or_create_role(self, cursor, role_name):
+        self.ensure_loaded(cursor)
+        role_id = self.ids_by_name.get(role_name)
+        if role_id is not None:
+            return role_id
 
-    pg_cursor.execute("SELECT MAX(idrole) FROM data.role")
-    pg_max = pg_cursor.fetchone()[0] or 0
+        pg_role_id = self.pg_ids_by_system_name.get(role_name.lower())
+        if pg_role_id is not None:
+            return self.add(cursor, pg_role_id, role_name)
 
-    execute_with_normalization(cursor,
-        """
-        SELECT MAX(CAST(id AS INTEGER))
-        FROM roles
-        WHERE CAST(id AS INTEGER) > ?
-        """,
-                               (pg_max,)
-                               )
-    local_max = cursor.fetchone()[0]
+        return self.add(cursor, self.next_id, role_name)
 
-    next_id = pg_max + 1 if local_max is None else local_max + 1
-    role_id = next_id
+    def ensure_role_id(self, cursor, role_id):
+        self.ensure_loaded(cursor)
+        role_id = int(role_id)
+        if role_id in self.known_ids:
+            return role_id
+        name = self.pg_names_by_id.get(role_id)
+        if name is None:
+            return None
+        return self.add(cursor, role_id, name)
 
-    execute_with_normalization(cursor,
-        "INSERT INTO roles (id, name) VALUES (?, ?)",
-                               (role_id, role_name)
-                               )
 
-    return role_id
+ROLE_REGISTRY = RoleRegistry()
 
 
+def get_role_id(cursor, role_name):
+    return ROLE_REGISTRY.get_role_id(cursor, role_name)
+
+
+def get_or_create_role(cursor, role_name):
+    return ROLE_REGISTRY.get_or_create_role(cursor, role_name)
+
+
+class RegionTree:
+    """data.region loaded once, with memoized root-to-leaf paths and the set of locations already written."""
+
+    def __init__(self):
+        self.loaded = False
+
+    def load(self, pg_cursor):
+        pg_cursor.execute("""
+            SELECT identity, name, historical_name, parent_idregion
+            FROM data.region
+        """)
+        self.regions = {
+            int(identity): (int(identity), name, historical_name, int(parent_id) if parent_id else None)
+            for identity, name, historical_name, parent_id in pg_cursor.fetchall()
+        }
+        self.paths = {}
+        self.inserted = set()
+        self.loaded = True
+
+    def ensure_loaded(self, pg_cursor):
+        if not self.loaded:
+            self.load(pg_cursor)
+
+    def get_hierarchy(self, region_id):
+        region_id = int(region_id)
+        if region_id in self.paths:
+            return self.paths[region_id]
+
+        hierarchy = []
+        seen = set()
+        current_id = region_id
+        while current_id and current_id not in seen:
+            if current_id in self.paths:
+                hierarchy = self.paths[current_id] + hierarchy
+                break
+            row = self.regions.get(current_id)
+            if not row:
+                break
+            seen.add(current_id)
+            hierarchy.insert(0, row)
+            current_id = row[3]
+
+        self.paths[region_id] = hierarchy
+        return hierarchy
+
+    def insert_location(self, writer, pg_cursor, region_id):
+        self.ensure_loaded(pg_cursor)
+        hierarchy = self.get_hierarchy(region_id)
+        missing = [row for row in hierarchy if row[0] not in self.inserted]
+        if missing:
+            writer.add_many("""
+                INSERT OR IGNORE INTO location (id, name, historical_name, parent_id)
+                VALUES (?, ?, ?, ?)
+            """, missing)
+            self.inserted.update(row[0] for row in missing)
+        return hierarchy[-1][0] if hierarchy else None
+
+
+REGION_TREE = RegionTree()
+
+
+_INDEX_DOC_COUNTS = None
+DBBE_INDEX_SUFFIXES = ("verses", "persons", "manuscripts", "occurrences", "types", "bibliographies")
+
+
+def get_snapshot_mode() -> str:
+    return os.getenv("ES_SNAPSHOT_MODE", "").lower()
+
+
+def load_snapshot_manifest():
+    if not SNAPSHOT_MANIFEST_PATH.exists():
+        return {}
+    with open(SNAPSHOT_MANIFEST_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_replay_index_doc_counts():
+    # A replay must never quietly build an archive without some of its entities
+    if not SNAPSHOT_MANIFEST_PATH.exists():
+        raise FileNotFoundError(f"No snapshot manifest at {SNAPSHOT_MANIFEST_PATH}, record one with ES_SNAPSHOT_MODE=record")
+    manifest = load_snapshot_manifest()
+    missing = [suffix for suffix in DBBE_INDEX_SUFFIXES if not any(index.endswith(suffix) for index in manifest)]
+    if missing:
+        raise FileNotFoundError(f"No snapshot of the {', '.join(missing)} index in {SNAPSHOT_DIR}, "
+                                f"record one with ES_SNAPSHOT_MODE=record")
+    return manifest
+
+
+def get_dbbe_index_doc_counts(es):
+    # Resolved once per run; docs.count comes from the same _cat call and drives progress reporting
+    global _INDEX_DOC_COUNTS
+    if _INDEX_DOC_COUNTS is None and get_snapshot_mode() == "replay":
+        _INDEX_DOC_COUNTS = load_replay_index_doc_counts()
+    if _INDEX_DOC_COUNTS is None:
+        indices = es.cat.indices(format="json")
+        _INDEX_DOC_COUNTS = {
+            idx['index']: int(idx.get('docs.count') or 0)
+            for idx in indices if idx['index'].startswith("dbbe_dev")
+        }
+    return _INDEX_DOC_COUNTS
 
 
 def get_dbbe_indices(es):
-    indices = es.cat.indices(format="json")
-    return [idx['index'] for idx in indices if idx['index'].startswith("dbbe_dev")]
+    return list(get_dbbe_index_doc_counts(es))
+
+def get_sqlite_batch_size() -> int:
+    return max(1, get_int_env("SQLITE_BATCH_SIZE", 5000))
+
+
+def get_sqlite_writer_thread() -> bool:
+    return get_bool_env("SQLITE_WRITER_THREAD", True)
+
+
+class SQLiteWriter:
+    """The only writer on a step's SQLite connection: runs queued batches in order and group-commits them."""
+
+    def __init__(self, conn, commit_rows=None, commit_seconds=None, max_pending_batches=4):
+        self.conn = conn
+        self.commit_rows = commit_rows or get_int_env("SQLITE_COMMIT_ROWS", 50000)
+        self.commit_seconds = commit_seconds or get_int_env("SQLITE_COMMIT_SECONDS", 5)
+        # Bounded so a slow disk throttles extraction instead of buffering the whole index in memory
+        self.batches = queue.Queue(maxsize=max_pending_batches)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        cursor = self.conn.cursor()
+        uncommitted_rows = 0
+        last_commit = time.monotonic()
+
+        while True:
+            kind, payload = self.batches.get()
+            try:
+                if self.error is not None:
+                    pass
+                elif kind == "batch":
+                    if not self.conn.in_transaction:
+                        cursor.execute("BEGIN")
+                    for query, rows in payload:
+                        cursor.executemany(query, rows)
+                        uncommitted_rows += len(rows)
+                    if uncommitted_rows >= self.commit_rows or time.monotonic() - last_commit >= self.commit_seconds:
+                        cursor.execute("COMMIT")
+                        uncommitted_rows = 0
+                        last_commit = time.monotonic()
+                elif self.conn.in_transaction:
+                    cursor.execute("COMMIT")
+                    uncommitted_rows = 0
+                    last_commit = time.monotonic()
+            except Exception as e:
+                # Keep draining so producers never block on a full queue; the error surfaces on their next call
+                self.error = e
+            if kind != "batch":
+                payload.set()
+            if kind == "stop":
+                return
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, batch):
+        self._check()
+        self.batches.put(("batch", batch))
+
+    def _wait(self, kind):
+        done = threading.Event()
+        self.batches.put((kind, done))
+        done.wait()
+        self._check()
+
+    def sync(self):
+        self._wait("sync")
+
+    def close(self):
+        self._wait("stop")
+        self.thread.join()
+
+
+class BatchWriter:
+    """Buffers writes as runs of the same statement and flushes them with executemany in the order added."""
+
+    def __init__(self, cursor, batch_size=None, sink=None):
+        self.cursor = cursor
+        self.batch_size = batch_size or get_sqlite_batch_size()
+        self.sink = sink
+        self.pending = []
+        self.pending_rows = 0
+
+    def add(self, query, params):
+        if self.pending and self.pending[-1][0] == query:
+            self.pending[-1][1].append(params)
+        else:
+            self.pending.append((query, [params]))
+        self.pending_rows += 1
+        if self.pending_rows >= self.batch_size:
+            self.flush()
+
+    def add_many(self, query, rows):
+        for params in rows:
+            self.add(query, params)
+
+    def flush(self):
+        if not self.pending_rows:
+            return
+        batch = [(query, normalize_value(rows)) for query, rows in self.pending]
+        self.pending = []
+        self.pending_rows = 0
+
+        if self.sink is not None:
+            self.sink.submit(batch)
+            return
+
+        # Outside an explicit transaction every executemany row would otherwise commit on its own
+        own_transaction = not self.cursor.connection.in_transaction
+        if own_transaction:
+            self.cursor.execute("BEGIN")
+        for query, rows in batch:
+            self.cursor.executemany(query, rows)
+        if own_transaction:
+            self.cursor.execute("COMMIT")
+
+    def sync(self):
+        self.flush()
+        if self.sink is not None:
+            self.sink.sync()
+
+    def close(self):
+        self.flush()
+        if self.sink is not None:
+            self.sink.close()
+
+
+def get_db_writer(conn, cursor, batch_size=None):
+    sink = SQLiteWriter(conn) if get_sqlite_writer_thread() else None
+    return BatchWriter(cursor, batch_size, sink=sink)
+
 
 def insert_many_to_many(
-    cursor,
+    writer,
     source: dict,
     source_key: str,
     entity_table: str,
@@ -216,21 +925,21 @@ def insert_many_to_many(
         if not item_id or not item_name:
             continue
 
-        execute_with_normalization(cursor,
+        writer.add(
             f"INSERT OR IGNORE INTO {entity_table} (id, name) VALUES (?, ?)",
-                                   (item_id, item_name),
-                                   )
+            (item_id, item_name),
+        )
 
-        execute_with_normalization(cursor,
+        writer.add(
             f"""
             INSERT OR IGNORE INTO {join_table}
             ({parent_id_col}, {entity_id_col})
             VALUES (?, ?)
             """,
-                                   (parent_id, item_id),
-                                   )
+            (parent_id, item_id),
+        )
 
-def insert_many_to_one(cursor, entity_name, table_name, manuscript_id, entity_data):
+def insert_many_to_one(writer, entity_name, table_name, manuscript_id, entity_data):
     if not entity_data:
         return
 
@@ -238,16 +947,15 @@ def insert_many_to_one(cursor, entity_name, table_name, manuscript_id, entity_da
     entity_name_val = entity_data.get("name", "")
 
     if entity_id and entity_name_val:
-        execute_with_normalization(cursor,
+        writer.add(
             f"INSERT OR IGNORE INTO {table_name} (id, name) VALUES (?, ?)",
-                                   (entity_id, entity_name_val)
-                                   )
-        execute_with_normalization(cursor,
+            (entity_id, entity_name_val)
+        )
+        writer.add(
             f"UPDATE manuscript SET {entity_name}_id = ? WHERE id = ?",
-                                   (entity_id, manuscript_id)
-                                   )
+            (entity_id, manuscript_id)
+        )
 
 def get_public_release() -> bool:
-    public_release = os.getenv("PUBLIC_RELEASE", "true")
-    return public_release.lower() in {"1", "true", "yes", "on"}
+    return get_bool_env("PUBLIC_RELEASE", True)
 
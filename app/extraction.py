@@ -0,0 +1,461 @@
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+from elasticsearch import ConnectionError as ESConnectionError, ConnectionTimeout, NotFoundError
+
+from app.common import (MAIN_DB_PATH, ROLE_FIELD_TO_ROLE_NAME, SNAPSHOT_DIR, SNAPSHOT_MANIFEST_PATH, scroll_pages,
+                        get_dbbe_index_doc_counts, get_snapshot_mode, load_snapshot_manifest, build_database_exists,
+                        get_build_db_path, get_sqlite_build_mode, get_bool_env, get_int_env)
+
+CHECKPOINT_DIR = MAIN_DB_PATH.parent / "checkpoints"
+CHECKPOINT_BUILD_PATH = CHECKPOINT_DIR / "_build.json"
+PIT_KEEP_ALIVE = "2m"
+STALLED_PAGE_SECONDS = 60
+
+_ROLE_SOURCE_FIELDS = [f"{role_field}.id" for role_field in ROLE_FIELD_TO_ROLE_NAME]
+
+# _source fields read by the migrations, keyed by index suffix. Keep in sync when a migration reads a new field.
+SOURCE_FIELDS = {
+    "verses": ["id", "verse", "order", "occurrence.id", "group_id"],
+    "persons": ["public"],
+    "occurrences": [
+        "id", "public", "private_comment", "created", "modified", "public_comment", "dbbe",
+        "incipit", "text_stemmer", "text_original", "location", "completion_floor", "completion_ceiling",
+        "palaeographical_info", "contextual_info", "manuscript.id", "title_original", "subject.id",
+        "genre", "metre", "acknowledgement", "management", "text_status",
+        *_ROLE_SOURCE_FIELDS,
+    ],
+    "types": [
+        "id", "public", "private_comment", "text_stemmer", "text_original", "lemma", "incipit",
+        "created", "modified", "public_comment", "title_original", "tag", "critical_status",
+        "text_status", "subject.id", "genre", "metre", "acknowledgement", "management",
+        "occurrence_ids",
+        *_ROLE_SOURCE_FIELDS,
+    ],
+    "manuscripts": [
+        "id", "public", "private_comment", "name", "completion_floor", "completion_ceiling",
+        "created", "modified", "public_comment", "number_of_occurrences", "shelf", "management",
+        "acknowledgement", "collection", "content.id", "diktyon",
+        *_ROLE_SOURCE_FIELDS,
+    ],
+    "bibliographies": ["title", "title_sort_key"],
+}
+
+_PAGE = "page"
+_DONE = "done"
+_FAILED = "failed"
+
+
+def get_source_fields(index):
+    for suffix, fields in SOURCE_FIELDS.items():
+        if index.endswith(suffix):
+            return fields
+    return None
+
+
+def build_index_query(index, size=1000, public_only=False):
+    query = {"query": {"match_all": {}}, "size": size}
+    if public_only:
+        query["query"] = {"bool": {"filter": [{"term": {"public": True}}]}}
+    fields = get_source_fields(index)
+    if fields is not None:
+        query["_source"] = {"includes": fields}
+    return query
+
+
+def private_documents_query():
+    return {"bool": {"must_not": [{"term": {"public": True}}]}}
+
+
+def is_public_hit(hit):
+    return bool(hit["_source"].get("public", False))
+
+
+def count_private_documents(es, index):
+    if get_snapshot_mode() == "replay":
+        return sum(1 for hits in replay_pages(index) for hit in hits if not is_public_hit(hit))
+    return es.count(index=index, query=private_documents_query())["count"]
+
+
+def iter_private_ids(es, index, size=1000):
+    if get_snapshot_mode() == "replay":
+        for hits in replay_pages(index, size=size):
+            for hit in hits:
+                if not is_public_hit(hit):
+                    yield str(hit["_source"].get("id", hit["_id"]))
+        return
+
+    query = {"query": private_documents_query(), "size": size, "_source": ["id"]}
+    for hits in scroll_pages(es, index, query=query):
+        for hit in hits:
+            yield str(hit["_source"].get("id", hit["_id"]))
+
+
+def get_adaptive_page_size() -> bool:
+    return get_bool_env("ES_ADAPTIVE_PAGE_SIZE", True)
+
+
+def get_float_env(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return float(default)
+
+
+class AdaptivePageSize:
+    """Picks the next page size from how long the last page took and how large its documents were."""
+
+    SAMPLE_HITS = 20
+
+    def __init__(self, size):
+        self.min_size = int(get_float_env("ES_PAGE_SIZE_MIN", 100))
+        self.max_size = max(self.min_size, int(get_float_env("ES_PAGE_SIZE_MAX", 5000)))
+        self.target_seconds = get_float_env("ES_TARGET_PAGE_SECONDS", 1.0)
+        self.target_bytes = get_float_env("ES_TARGET_PAGE_MB", 10) * 1024 * 1024
+        self.size = self.clamp(size)
+
+    def clamp(self, size):
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    def update(self, hits, elapsed):
+        if not hits:
+            return self.size
+
+        sample = hits[:self.SAMPLE_HITS]
+        avg_doc_bytes = max(sum(len(json.dumps(hit.get("_source", {}))) for hit in sample) / len(sample), 1)
+        per_doc_seconds = max(elapsed, 1e-3) / len(hits)
+
+        desired = min(self.target_seconds / per_doc_seconds, self.target_bytes / avg_doc_bytes)
+        # Move at most a factor two per page so a single slow response does not collapse the page size
+        desired = max(self.size / 2, min(self.size * 2, desired))
+        self.size = self.clamp(desired)
+        return self.size
+
+
+def get_extraction_mode() -> str:
+    return os.getenv("ES_EXTRACTION_MODE", "scroll").lower()
+
+
+def get_pit_max_retries() -> int:
+    return max(0, get_int_env("ES_PIT_MAX_RETRIES", 5))
+
+
+def get_scroll_slices() -> int:
+    return max(1, get_int_env("ES_SCROLL_SLICES", 1))
+
+
+def sliced_scroll_pages(es, index, slices, query=None, size=1000):
+    if query is None:
+        query = {"query": {"match_all": {}}, "size": size}
+
+    # Bounded so fast slices cannot run ahead of the SQLite writer and pile up pages in memory
+    pages = queue.Queue(maxsize=slices * 2)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_slice(slice_id):
+        slice_query = dict(query, slice={"id": slice_id, "max": slices})
+        started = time.monotonic()
+        doc_count = 0
+        try:
+            for hits in scroll_pages(es, index, query=slice_query, size=size):
+                doc_count += len(hits)
+                if not put((_PAGE, hits)):
+                    return
+        except Exception as e:
+            put((_FAILED, e))
+            return
+
+        elapsed = max(time.monotonic() - started, 1e-6)
+        print(f"Slice {slice_id + 1}/{slices} of {index}: {doc_count} docs in {elapsed:.1f}s "
+              f"({doc_count / elapsed:.0f} docs/s)")
+        put((_DONE, None))
+
+    workers = [
+        threading.Thread(target=read_slice, args=(slice_id,), daemon=True)
+        for slice_id in range(slices)
+    ]
+    for worker in workers:
+        worker.start()
+
+    remaining = slices
+    try:
+        while remaining:
+            kind, payload = pages.get()
+            if kind == _PAGE:
+                yield payload
+            elif kind == _DONE:
+                remaining -= 1
+            else:
+                raise payload
+    finally:
+        stop.set()
+
+
+def checkpoint_path(index):
+    return CHECKPOINT_DIR / f"{index}.json"
+
+
+def load_checkpoint(index):
+    path = checkpoint_path(index)
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(index, search_after, doc_count, done=False):
+    CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+    path = checkpoint_path(index)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"search_after": search_after, "doc_count": doc_count, "done": done}, f)
+    os.replace(tmp_path, path)
+
+
+def clear_checkpoints():
+    shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
+
+
+def reset_stale_checkpoints():
+    # Checkpoints only make sense next to the database, and in the build mode, they were written for
+    build = {"target": str(get_build_db_path()), "mode": get_sqlite_build_mode()}
+    stored = None
+    if CHECKPOINT_BUILD_PATH.exists():
+        with open(CHECKPOINT_BUILD_PATH, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+    if not build_database_exists() or stored != build:
+        clear_checkpoints()
+    CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CHECKPOINT_BUILD_PATH, "w", encoding="utf-8") as f:
+        json.dump(build, f)
+
+
+def close_point_in_time(es, pit_id):
+    if pit_id is None:
+        return
+    try:
+        es.close_point_in_time(id=pit_id)
+    except Exception:
+        pass
+
+
+def pit_pages(es, index, query=None, size=1000, sort_field="id", resumable=False, before_checkpoint=None):
+    if query is None:
+        query = {"query": {"match_all": {}}, "size": size}
+
+    checkpoint = (load_checkpoint(index) if resumable else None) or {}
+    if checkpoint.get("done"):
+        print(f"Skipping {index}: already fully extracted according to checkpoint")
+        return
+    search_after = checkpoint.get("search_after")
+    doc_count = checkpoint.get("doc_count", 0)
+    if search_after is not None:
+        print(f"Resuming {index} after {doc_count} docs from checkpoint")
+
+    # Unlike a scroll, every search_after request can ask for a different page size
+    page_size = AdaptivePageSize(query.get("size", size)) if get_adaptive_page_size() else None
+
+    pit_id = None
+    retries = 0
+    try:
+        while True:
+            try:
+                if pit_id is None:
+                    pit_id = es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)["id"]
+                body = dict(query, pit={"id": pit_id, "keep_alive": PIT_KEEP_ALIVE}, sort=[{sort_field: "asc"}])
+                if page_size:
+                    body["size"] = page_size.size
+                if search_after is not None:
+                    body["search_after"] = search_after
+
+                started = time.monotonic()
+                resp = es.search(body=body)
+            except (ESConnectionError, ConnectionTimeout, NotFoundError) as e:
+                # An expired point in time also surfaces as a 404; reopen it and continue from the last sort value
+                retries += 1
+                if retries > get_pit_max_retries():
+                    raise
+                print(f"Extraction of {index} interrupted ({e}), retry {retries} from checkpoint")
+                close_point_in_time(es, pit_id)
+                pit_id = None
+                time.sleep(min(2 ** retries, 30))
+                continue
+
+            retries = 0
+            pit_id = resp.get("pit_id", pit_id)
+            hits = resp["hits"]["hits"]
+            if not hits:
+                break
+            if page_size:
+                page_size.update(hits, time.monotonic() - started)
+
+            yield hits
+
+            # Only reached once the consumer asks for the next page, i.e. after it handed this one to SQLite
+            search_after = hits[-1]["sort"]
+            doc_count += len(hits)
+            if resumable:
+                if before_checkpoint:
+                    before_checkpoint()
+                save_checkpoint(index, search_after, doc_count)
+
+        if resumable:
+            if before_checkpoint:
+                before_checkpoint()
+            save_checkpoint(index, search_after, doc_count, done=True)
+    finally:
+        close_point_in_time(es, pit_id)
+
+
+_manifest_lock = threading.Lock()
+
+
+def snapshot_path(index):
+    return SNAPSHOT_DIR / f"{index}.jsonl.gz"
+
+
+def save_snapshot_manifest_entry(index, doc_count):
+    # The prefetch thread can record an index while the main thread records another
+    with _manifest_lock:
+        manifest = load_snapshot_manifest()
+        manifest[index] = doc_count
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = SNAPSHOT_MANIFEST_PATH.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, SNAPSHOT_MANIFEST_PATH)
+
+
+def record_pages(pages, index):
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    path = snapshot_path(index)
+    tmp_path = path.with_name(path.name + ".tmp")
+    doc_count = 0
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for hits in pages:
+            for hit in hits:
+                f.write(json.dumps({"_id": hit["_id"], "_source": hit["_source"]}, ensure_ascii=False))
+                f.write("\n")
+            doc_count += len(hits)
+            yield hits
+
+    # Only a fully read index replaces the previous snapshot
+    os.replace(tmp_path, path)
+    save_snapshot_manifest_entry(index, doc_count)
+    print(f"Recorded {doc_count} docs of {index} to {path}")
+
+
+def replay_pages(index, size=1000):
+    path = snapshot_path(index)
+    if not path.exists():
+        raise FileNotFoundError(f"No snapshot of {index} in {SNAPSHOT_DIR}, record one with ES_SNAPSHOT_MODE=record")
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        page = []
+        for line in f:
+            page.append(json.loads(line))
+            if len(page) >= size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+def public_pages(pages):
+    for hits in pages:
+        public_hits = [hit for hit in hits if is_public_hit(hit)]
+        if public_hits:
+            yield public_hits
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+def track_progress(pages, index, total):
+    # total is the docs.count from _cat/indices, so it is an upper bound for filtered queries
+    started = time.monotonic()
+    last_page = started
+    doc_count = 0
+    try:
+        for hits in pages:
+            yield hits
+
+            now = time.monotonic()
+            doc_count += len(hits)
+            rate = doc_count / max(now - started, 1e-6)
+            if total:
+                remaining = max(total - doc_count, 0)
+                print(f"{index}: {doc_count}/{total} docs ({min(doc_count / total, 1):.0%}), "
+                      f"{rate:.0f} docs/s, ETA {format_duration(remaining / rate)}")
+            else:
+                print(f"{index}: {doc_count} docs, {rate:.0f} docs/s")
+            if now - last_page > STALLED_PAGE_SECONDS:
+                print(f"Warning: last page of {index} took {format_duration(now - last_page)}, step may be stalled")
+            last_page = now
+    finally:
+        close = getattr(pages, "close", None)
+        if close:
+            close()
+
+    print(f"{index}: {doc_count} docs in {format_duration(time.monotonic() - started)}")
+
+
+def iter_index_pages(es, index, query=None, size=1000, resumable=False, public_only=False, before_checkpoint=None):
+    total = get_dbbe_index_doc_counts(es).get(index)
+    if total:
+        # No point asking for pages larger than the whole index
+        size = min(size, total)
+
+    snapshot_mode = get_snapshot_mode()
+    if snapshot_mode == "replay":
+        pages = replay_pages(index, size=size)
+        if public_only:
+            pages = public_pages(pages)
+        return track_progress(pages, index, total)
+
+    if snapshot_mode == "record":
+        # Snapshots hold full, unfiltered documents so they stay usable after transform changes and for private builds
+        query = {"query": {"match_all": {}}, "size": size}
+        pages = record_pages(_index_pages(es, index, query, size, resumable=False), index)
+        if public_only:
+            pages = public_pages(pages)
+        return track_progress(pages, index, total)
+
+    if query is None:
+        query = build_index_query(index, size=size, public_only=public_only)
+
+    return track_progress(_index_pages(es, index, query, size, resumable, before_checkpoint), index, total)
+
+
+def _index_pages(es, index, query, size, resumable, before_checkpoint=None):
+    # Resumable consumers must have committed every page by the time before_checkpoint returns
+    mode = get_extraction_mode()
+    if mode == "pit":
+        return pit_pages(es, index, query=query, size=size, resumable=resumable, before_checkpoint=before_checkpoint)
+    if mode == "async":
+        from app.async_extraction import get_async_extractor
+        return get_async_extractor().index_pages(index, query=query, size=size, slices=get_scroll_slices())
+
+    # Elasticsearch rejects a slice max of 1, so a single slice is just a plain scroll
+    slices = get_scroll_slices()
+    if slices > 1:
+        print(f"Reading {index} with {slices} parallel scroll slices")
+        return sliced_scroll_pages(es, index, slices, query=query, size=size)
+    return scroll_pages(es, index, query=query, size=size)
@@ -1,4 +1,4 @@
-from .common import MAIN_DB_PATH, get_db_connection, execute_with_normalization
+from .common import get_build_db_path, get_db_connection, execute_with_normalization
 
 BIBLIO_type = {
     "article",
@@ -266,7 +266,7 @@ def create_base_tables():
 
     conn.commit()
     conn.close()
-    print(f"Base tables created in '{MAIN_DB_PATH}'")
+    print(f"Base tables created in '{get_build_db_path()}'")
 
 if __name__ == "__main__":
     create_base_tables()
@@ -1,5 +1,6 @@
 # app/migrate_bibliographies/__init__.py
 
+from app.common import check_foreign_keys
 from .schema import create_schema
 from .link_chapters_to_books import migrate_book_chapters
 from .link_managements_to_bibliographies import migrate_managements
@@ -35,5 +36,7 @@ def migrate_bibliographies():
     run_step("migrate_journals", migrate_journals)
     run_step("migrate_person_role", migrate_person_role)
     run_step("migrate_managements", migrate_managements)
+    # cleanup rebuilds the link tables without their foreign keys, so the deferred check has to run first
+    run_step("check_foreign_keys", check_foreign_keys)
     run_step("cleanup_bibliographies", cleanup_bibliographies)
 
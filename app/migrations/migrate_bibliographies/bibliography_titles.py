@@ -0,0 +1,57 @@
+# app/migrate_bibliographies/bibliography_titles.py
+import threading
+from concurrent.futures import Future
+
+from app.common import get_es_client, get_dbbe_indices
+from app.extraction import iter_index_pages
+
+_titles_cache = None
+_prefetch = None
+
+
+def read_bibliography_titles(es):
+    indices = get_dbbe_indices(es)
+    biblio_index = next((idx for idx in indices if idx.endswith("bibliographies")), None)
+
+    titles = {}
+    if not biblio_index:
+        print("No bibliography index found")
+    else:
+        for hits in iter_index_pages(es, biblio_index):
+            for hit in hits:
+                src = hit["_source"]
+                titles[str(hit["_id"])] = {
+                    "title": src.get("title", ""),
+                    "title_sort_key": src.get("title_sort_key", "")
+                }
+        print(f"Loaded {len(titles)} bibliography titles from index: {biblio_index}")
+    return titles
+
+
+def prefetch_bibliography_titles(es=None):
+    # Reads the bibliography index on a background thread while the earlier steps run
+    global _prefetch
+    if _titles_cache is not None or _prefetch is not None:
+        return
+
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(read_bibliography_titles(es or get_es_client()))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    _prefetch = future
+
+
+def load_bibliography_titles(es=None):
+    global _titles_cache, _prefetch
+    if _titles_cache is None:
+        if _prefetch is not None:
+            _titles_cache = _prefetch.result()
+            _prefetch = None
+        else:
+            _titles_cache = read_bibliography_titles(es or get_es_client())
+    return _titles_cache
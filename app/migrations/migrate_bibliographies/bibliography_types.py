@@ -0,0 +1,36 @@
+# app/migrate_bibliographies/bibliography_types.py
+from app.common import get_postgres_connection
+from .biblio_type_enum import BiblioType
+
+BIBLIO_TYPE_TABLES = {
+    BiblioType.ARTICLE: "article",
+    BiblioType.BLOG_POST: "blog_post",
+    BiblioType.BOOK: "book",
+    BiblioType.BOOK_CHAPTER: "bookchapter",
+    BiblioType.ONLINE_SOURCE: "online_source",
+    BiblioType.PHD: "phd",
+    BiblioType.BIB_VARIA: "bib_varia",
+}
+
+_types_cache = None
+
+
+def load_bibliography_types():
+    global _types_cache
+    if _types_cache is not None:
+        return _types_cache
+
+    pg_conn, pg_cursor = get_postgres_connection()
+    pg_cursor.execute("\n        UNION ALL\n".join(
+        f"SELECT identity, '{bib_type.value}' FROM data.{table}"
+        for bib_type, table in BIBLIO_TYPE_TABLES.items()
+    ))
+    types = {}
+    for identity, bib_type in pg_cursor.fetchall():
+        # First table wins, in BIBLIO_TYPE_TABLES order
+        types.setdefault(str(identity), BiblioType(bib_type))
+    pg_conn.close()
+    print(f"Loaded {len(types)} bibliography types")
+
+    _types_cache = types
+    return types
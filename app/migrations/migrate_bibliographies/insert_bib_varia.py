@@ -5,28 +5,7 @@ from app.common import (
     get_es_client,
     get_public_release
 )
-
-
-def get_biblio_titles_from_es(biblio_ids, es):
-    index = "dbbe_dev_bibliographies"
-    titles = {}
-    CHUNK = 500
-
-    for i in range(0, len(biblio_ids), CHUNK):
-        chunk = biblio_ids[i:i + CHUNK]
-        res = es.mget(index=index, body={"ids": chunk})
-
-        for doc in res["docs"]:
-            if doc.get("found"):
-                src = doc["_source"]
-                titles[doc["_id"]] = {
-                    "title": src.get("title", ""),
-                    "title_sort_key": src.get("title_sort_key", "")
-                }
-            else:
-                titles[doc["_id"]] = {"title": "", "title_sort_key": ""}
-
-    return titles
+from .bibliography_titles import load_bibliography_titles
 
 
 def preload_locations(cursor):
@@ -69,10 +48,8 @@ def insert_bib_varia():
     """)
 
     rows = pg_cursor.fetchall()
-    biblio_ids = [str(r[0]) for r in rows]
 
-    # Fetch titles from ES
-    titles_cache = get_biblio_titles_from_es(biblio_ids, es)
+    titles_cache = load_bibliography_titles(es)
 
     is_public_release = get_public_release()
 
@@ -5,30 +5,17 @@ from app.common import (
     get_es_client,
     get_public_release
 )
+from .bibliography_titles import load_bibliography_titles
+from .bibliography_types import load_bibliography_types
 from .biblio_type_enum import BiblioType
 from collections import defaultdict
 
-
-def get_biblio_titles_from_es(biblio_ids, es):
-    index = "dbbe_dev_bibliographies"
-    titles = {}
-    CHUNK = 500
-
-    for i in range(0, len(biblio_ids), CHUNK):
-        chunk = biblio_ids[i:i + CHUNK]
-        res = es.mget(index=index, body={"ids": chunk})
-
-        for doc in res["docs"]:
-            if doc.get("found"):
-                src = doc["_source"]
-                titles[doc["_id"]] = {
-                    "title": src.get("title", ""),
-                    "title_sort_key": src.get("title_sort_key", "")
-                }
-            else:
-                titles[doc["_id"]] = {"title": "", "title_sort_key": ""}
-
-    return titles
+INSERTED_BIBLIO_TYPES = {
+    BiblioType.ARTICLE,
+    BiblioType.BOOK_CHAPTER,
+    BiblioType.ONLINE_SOURCE,
+    BiblioType.PHD,
+}
 
 
 def insert_bibliographies():
@@ -36,100 +23,55 @@ def insert_bibliographies():
     pg_conn, pg_cursor = get_postgres_connection()
     es = get_es_client()
 
+    biblio_types = load_bibliography_types()
+    identities = [
+        identity for identity, bib_type in biblio_types.items()
+        if bib_type in INSERTED_BIBLIO_TYPES
+    ]
+
     pg_cursor.execute("""
-        SELECT biblio.identity,
-               biblio.bib_type,
-               entity.created,
-               entity.modified,
-               entity.public_comment,
-               entity.private_comment,
-               blog.url
-        FROM (
-            SELECT identity, 'article' AS bib_type FROM data.article
-            UNION ALL
-            SELECT identity, 'book_chapter' FROM data.bookchapter
-            UNION ALL
-            SELECT identity, 'online_source' FROM data.online_source
-            UNION ALL
-            SELECT identity, 'phd' FROM data.phd
-            UNION ALL
-            SELECT identity, 'blog' FROM data.blog
-        ) AS biblio
-        LEFT JOIN data.entity entity
-            ON entity.identity = biblio.identity
-        LEFT JOIN data.blog blog
-            ON blog.identity = biblio.identity
-    """)
+        SELECT identity, created, modified, public_comment, private_comment
+        FROM data.entity
+        WHERE identity = ANY(%s)
+    """, ([int(identity) for identity in identities],))
+    entities = {str(row[0]): row[1:] for row in pg_cursor.fetchall()}
 
-    rows = pg_cursor.fetchall()
-    biblio_ids = [str(r[0]) for r in rows]
-    titles_cache = get_biblio_titles_from_es(biblio_ids, es)
+    titles_cache = load_bibliography_titles(es)
     is_public_release = get_public_release()
 
     biblio_rows_by_type = defaultdict(list)
-    for identity, bib_type, created, modified, public_comment, private_comment, url in rows:
-        identity_str = str(identity)
+    for identity_str in identities:
+        created, modified, public_comment, private_comment = entities.get(identity_str, (None, None, None, None))
         title_data = titles_cache.get(identity_str, {})
 
         private_comment_val = None
         if not is_public_release:
             private_comment_val = private_comment
 
-        if bib_type == "blog":
-            biblio_rows_by_type[bib_type].append(
-                (
-                    identity_str,
-                    title_data.get("title", ""),
-                    title_data.get("title_sort_key", ""),
-                    created,
-                    modified,
-                    public_comment,
-                    private_comment_val,
-                    url
-                )
-            )
-        else:
-            biblio_rows_by_type[bib_type].append(
-                (
-                    identity_str,
-                    title_data.get("title", ""),
-                    title_data.get("title_sort_key", ""),
-                    created,
-                    modified,
-                    public_comment,
-                    private_comment_val
-                )
+        biblio_rows_by_type[biblio_types[identity_str]].append(
+            (
+                identity_str,
+                title_data.get("title", ""),
+                title_data.get("title_sort_key", ""),
+                created,
+                modified,
+                public_comment,
+                private_comment_val
             )
+        )
 
     execute_with_normalization(cursor, "BEGIN")
 
-    for bib_type, insert_rows in biblio_rows_by_type.items():
-        bib_type_enum = next(
-            (bt for bt in BiblioType if bt.value == bib_type),
-            None
+    for bib_type_enum, insert_rows in biblio_rows_by_type.items():
+        cursor.executemany(
+            f"""INSERT OR IGNORE INTO {bib_type_enum.value}
+                (id, title, title_sort_key,
+                 created, modified,
+                 public_comment, private_comment)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            insert_rows
         )
 
-        if bib_type_enum:
-            if bib_type == "blog":
-                cursor.executemany(
-                    f"""INSERT OR IGNORE INTO {bib_type_enum.value}
-                        (id, title, title_sort_key,
-                         created, modified,
-                         public_comment, private_comment,
-                         url)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                    insert_rows
-                )
-            else:
-                cursor.executemany(
-                    f"""INSERT OR IGNORE INTO {bib_type_enum.value}
-                        (id, title, title_sort_key,
-                         created, modified,
-                         public_comment, private_comment)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                    insert_rows
-                )
-
     execute_with_normalization(cursor, "COMMIT")
     conn.close()
     pg_conn.close()
\ No newline at end of file
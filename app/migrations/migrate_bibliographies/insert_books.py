@@ -5,31 +5,10 @@ from app.common import (
     get_es_client,
     get_public_release
 )
+from .bibliography_titles import load_bibliography_titles
 from .biblio_type_enum import BiblioType
 
 
-def get_biblio_titles_from_es(biblio_ids, es):
-    index = "dbbe_dev_bibliographies"
-    titles = {}
-    CHUNK = 500
-
-    for i in range(0, len(biblio_ids), CHUNK):
-        chunk = biblio_ids[i:i + CHUNK]
-        res = es.mget(index=index, body={"ids": chunk})
-
-        for doc in res["docs"]:
-            if doc.get("found"):
-                src = doc["_source"]
-                titles[doc["_id"]] = {
-                    "title": src.get("title", ""),
-                    "title_sort_key": src.get("title_sort_key", "")
-                }
-            else:
-                titles[doc["_id"]] = {"title": "", "title_sort_key": ""}
-
-    return titles
-
-
 def insert_books():
     conn, cursor = get_db_connection()
     pg_conn, pg_cursor = get_postgres_connection()
@@ -47,8 +26,7 @@ def insert_books():
     """)
 
     rows = pg_cursor.fetchall()
-    biblio_ids = [str(r[0]) for r in rows]
-    titles_cache = get_biblio_titles_from_es(biblio_ids, es)
+    titles_cache = load_bibliography_titles(es)
     is_public_release = get_public_release()
 
     insert_rows = []
@@ -1,4 +1,4 @@
-from app.common import execute_with_normalization, get_db_connection, get_postgres_connection
+from app.common import execute_with_normalization, get_db_connection, get_postgres_connection, copy_into_sqlite, BatchWriter
 
 def migrate_journals():
     conn, cursor = get_db_connection()
@@ -20,16 +20,29 @@ def migrate_journals():
         FROM data.journal j
         JOIN data.document_title dt ON j.identity = dt.iddocument
     """)
+    writer = BatchWriter(cursor)
     for journal_id, journal_title in pg_cursor.fetchall():
-        execute_with_normalization(cursor, """
+        writer.add("""
             INSERT INTO journal (id, title, title_sort_key)
             VALUES (?, ?, ?)
             ON CONFLICT(id) DO UPDATE SET
                 title = excluded.title,
                 title_sort_key = excluded.title_sort_key
         """, (str(journal_id), journal_title, journal_title))
+    # Journal issues reference the journals
+    writer.flush()
 
-    pg_cursor.execute("""
+    def issue_row(issue_id, journal_id, year, volume, number, series, forthcoming):
+        title_parts = []
+        if year: title_parts.append(year)
+        if series: title_parts.append(series)
+        if volume: title_parts.append(volume)
+        if number: title_parts.append(number)
+        if forthcoming == "t": title_parts.append("(forthcoming)")
+        issue_title = " ".join(title_parts) if title_parts else None
+        return issue_id, journal_id, issue_title, issue_title
+
+    copy_into_sqlite(pg_conn, """
         SELECT ji.identity AS issue_id,
                ji.idjournal AS journal_id,
                ji.year,
@@ -38,39 +51,26 @@ def migrate_journals():
                ji.series,
                ji.forthcoming
         FROM data.journal_issue ji
-    """)
-
-    for issue_id, journal_id, year, volume, number, series, forthcoming in pg_cursor.fetchall():
-        title_parts = []
-        if year: title_parts.append(str(year))
-        if series: title_parts.append(series)
-        if volume: title_parts.append(volume)
-        if number: title_parts.append(number)
-        if forthcoming: title_parts.append("(forthcoming)")
-        issue_title = " ".join(title_parts) if title_parts else None
-
-        execute_with_normalization(cursor, """
-            INSERT INTO journal_issue (id, journal_id, title, title_sort_key)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                journal_id = excluded.journal_id,
-                title = excluded.title,
-                title_sort_key = excluded.title_sort_key
-        """, (str(issue_id), str(journal_id), issue_title, issue_title))
+    """, cursor, """
+        INSERT INTO journal_issue (id, journal_id, title, title_sort_key)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            journal_id = excluded.journal_id,
+            title = excluded.title,
+            title_sort_key = excluded.title_sort_key
+    """, transform=issue_row)
 
     # --- Step 3: update article → journal_issue
-    pg_cursor.execute("""
-        SELECT a.identity AS article_id, dc.idcontainer AS issue_id
+    copy_into_sqlite(pg_conn, """
+        SELECT dc.idcontainer AS issue_id, a.identity AS article_id
         FROM data.article a
         JOIN data.document_contains dc ON dc.idcontent = a.identity
         JOIN data.journal_issue ji ON dc.idcontainer = ji.identity
+    """, cursor, """
+        UPDATE article
+        SET journal_issue_id = ?
+        WHERE id = ?
     """)
-    for article_id, issue_id in pg_cursor.fetchall():
-        execute_with_normalization(cursor, """
-            UPDATE article
-            SET journal_issue_id = ?
-            WHERE id = ?
-        """, (str(issue_id), str(article_id)))
 
     conn.commit()
     conn.close()
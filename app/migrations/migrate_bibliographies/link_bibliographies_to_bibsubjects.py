@@ -1,5 +1,6 @@
-from app.common import execute_with_normalization, get_db_connection, get_postgres_connection
-from .biblio_type_enum import BiblioType
+from app.common import (execute_with_normalization, get_db_connection, get_postgres_connection, copy_query, BatchWriter,
+                        get_deferred_foreign_keys, defer_references, load_ids)
+from .bibliography_types import load_bibliography_types
 from .biblio_entity_enum import BiblioEntity
 
 POSTGRES_TYPE_TO_ENTITY = {
@@ -13,7 +14,17 @@ def link_bibliographies_to_bibsubjects():
     conn, cursor = get_db_connection()
     pg_conn, pg_cursor = get_postgres_connection()
 
-    pg_cursor.execute("""
+    biblio_types = load_bibliography_types()
+    check_references = not get_deferred_foreign_keys()
+    if not check_references:
+        for bib_type_enum in set(biblio_types.values()):
+            for entity_enum in POSTGRES_TYPE_TO_ENTITY.values():
+                defer_references(f"{entity_enum.name.lower()}_{bib_type_enum.value}", entity_enum.sqlite_table)
+    entity_ids = {
+        entity_enum: load_ids(cursor, entity_enum.sqlite_table) for entity_enum in POSTGRES_TYPE_TO_ENTITY.values()
+    } if check_references else {}
+
+    batches = copy_query(pg_conn, """
         SELECT
             r.idsource AS biblio_id,
             r.idtarget AS entity_id,
@@ -41,26 +52,9 @@ def link_bibliographies_to_bibsubjects():
         LEFT JOIN (SELECT identity AS entity_id, 'translation' AS type FROM data.translation) tr
             ON r.idtarget = tr.entity_id
     """)
-    rows = pg_cursor.fetchall()
-
-    pg_cursor.execute("""
-        SELECT identity, 'article' AS bib_type FROM data.article
-        UNION ALL
-        SELECT identity, 'blog_post' FROM data.blog_post
-        UNION ALL
-        SELECT identity, 'book' FROM data.book
-        UNION ALL
-        SELECT identity, 'book_chapter' FROM data.bookchapter
-        UNION ALL
-        SELECT identity, 'online_source' FROM data.online_source
-        UNION ALL
-        SELECT identity, 'phd' FROM data.phd
-        UNION ALL
-        SELECT identity, 'bib_varia' FROM data.bib_varia
-    """)
-    biblio_type_map = {str(r[0]): r[1] for r in pg_cursor.fetchall()}
-    BIB_TYPE_ENUM_MAP = {bt.value: bt for bt in BiblioType}
+    rows = (row for batch in batches for row in batch)
 
+    writer = BatchWriter(cursor)
     execute_with_normalization(cursor, "BEGIN")
     for biblio_id, entity_id, entity_type_str, page_start, page_end, url, image, private_comment in rows:
         if not entity_type_str:
@@ -68,29 +62,22 @@ def link_bibliographies_to_bibsubjects():
         entity_enum = POSTGRES_TYPE_TO_ENTITY.get(entity_type_str)
         if not entity_enum:
             continue
-        bib_type = biblio_type_map.get(str(biblio_id))
-        if not bib_type:
-            continue
-        bib_type_enum = BIB_TYPE_ENUM_MAP.get(bib_type)
+        bib_type_enum = biblio_types.get(str(biblio_id))
         if not bib_type_enum:
             continue
 
-        execute_with_normalization(
-            cursor,
-            f"SELECT 1 FROM {entity_enum.name.lower()} WHERE id = ?",
-            (str(entity_id),)
-        )
-        if cursor.fetchone() is None:
+        if check_references and str(entity_id) not in entity_ids[entity_enum]:
             continue
 
         join_table = f"{entity_enum.name.lower()}_{bib_type_enum.value}"
         entity_col = f"{entity_enum.name.lower()}_id"
         bib_col = f"{bib_type_enum.value}_id"
 
-        execute_with_normalization(cursor,
+        writer.add(
             f"INSERT OR IGNORE INTO {join_table} ({entity_col}, {bib_col}, page_start, page_end,url, image, private_comment) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                   (str(entity_id), str(biblio_id), page_start, page_end, url, image, private_comment)
-                                   )
+            (str(entity_id), str(biblio_id), page_start, page_end, url, image, private_comment)
+        )
+    writer.flush()
     execute_with_normalization(cursor, "COMMIT")
     conn.close()
     pg_conn.close()
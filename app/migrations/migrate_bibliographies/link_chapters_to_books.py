@@ -1,24 +1,21 @@
 # app/migrate_bibliographies/link_chapters_to_books.py
-from app.common import execute_with_normalization, get_db_connection, get_postgres_connection
+from app.common import get_db_connection, get_postgres_connection, copy_into_sqlite
 
 def migrate_book_chapters():
     conn, cursor = get_db_connection()
     pg_conn, pg_cursor = get_postgres_connection()
 
-    pg_cursor.execute("""
-        SELECT bc.identity, b.identity
+    copy_into_sqlite(pg_conn, """
+        SELECT b.identity, bc.identity
         FROM data.bookchapter bc
         JOIN data.document_contains dc ON dc.idcontent = bc.identity
         JOIN data.book b ON dc.idcontainer = b.identity
+    """, cursor, """
+        UPDATE book_chapter
+        SET book_id = ?
+        WHERE id = ?
     """)
 
-    for chapter_id, book_id in pg_cursor.fetchall():
-        execute_with_normalization(cursor, """
-            UPDATE book_chapter
-            SET book_id = ?
-            WHERE id = ?
-        """, (str(book_id), str(chapter_id)))
-
     conn.commit()
     conn.close()
     pg_conn.close()
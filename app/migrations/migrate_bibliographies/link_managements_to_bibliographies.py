@@ -1,5 +1,5 @@
-from app.common import execute_with_normalization, get_db_connection, get_postgres_connection
-from .biblio_type_enum import BiblioType
+from app.common import execute_with_normalization, get_db_connection, get_postgres_connection, BatchWriter
+from .bibliography_types import load_bibliography_types
 
 def migrate_managements():
     conn, cursor = get_db_connection()
@@ -7,40 +7,19 @@ def migrate_managements():
 
     sqlite_management = {row[0] for row in execute_with_normalization(cursor, "SELECT id FROM management").fetchall()}
 
+    biblio_types = load_bibliography_types()
+
     pg_cursor.execute("""
-        SELECT
-            em.identity,
-            em.idmanagement,
-            COALESCE(
-                a.type::text, bp.type::text, b.type::text,
-                bc.type::text, os.type::text, p.type::text, bv.type::text
-            ) AS bib_type
-        FROM data.entity_management em
-        LEFT JOIN (SELECT identity,'article' type FROM data.article) a
-            ON em.identity = a.identity
-        LEFT JOIN (SELECT identity,'blog_post' type FROM data.blog_post) bp
-            ON em.identity = bp.identity
-        LEFT JOIN (SELECT identity,'book' type FROM data.book) b
-            ON em.identity = b.identity
-        LEFT JOIN (SELECT identity,'book_chapter' type FROM data.bookchapter) bc
-            ON em.identity = bc.identity
-        LEFT JOIN (SELECT identity,'online_source' type FROM data.online_source) os
-            ON em.identity = os.identity
-        LEFT JOIN (SELECT identity,'phd' type FROM data.phd) p
-            ON em.identity = p.identity
-        LEFT JOIN (SELECT identity,'bib_varia' type FROM data.bib_varia) bv
-            ON em.identity = bv.identity
+        SELECT identity, idmanagement
+        FROM data.entity_management
     """)
     rows = pg_cursor.fetchall()
 
-    for doc_id, mgmt_id, bib_type in rows:
-        if not bib_type:
-            continue
+    writer = BatchWriter(cursor)
+    execute_with_normalization(cursor, "BEGIN")
 
-        bib_type_enum = next(
-            (bt for bt in BiblioType if bt.value == bib_type.lower().replace(" ", "_")),
-            None
-        )
+    for doc_id, mgmt_id in rows:
+        bib_type_enum = biblio_types.get(str(doc_id))
         if not bib_type_enum:
             continue
 
@@ -58,15 +37,16 @@ def migrate_managements():
                                        )
             sqlite_management.add(mgmt_id)
 
-        execute_with_normalization(cursor,
+        writer.add(
             f"""
             INSERT OR IGNORE INTO {bib_type_enum.value}_management
                 (bibliography_id, management_id)
             VALUES (?, ?)
             """,
-                                   (doc_id, mgmt_id)
-                                   )
+            (doc_id, mgmt_id)
+        )
 
+    writer.flush()
     conn.commit()
     conn.close()
     pg_conn.close()
@@ -1,100 +1,51 @@
 # app/migrate_bibliographies/link_person_to_bibliographies.py
-import sqlite3
-from app.common import execute_with_normalization, get_db_connection, get_postgres_connection
-from .biblio_type_enum import BiblioType
-
-def exists(cursor, table, id_):
-    execute_with_normalization(cursor,
-        f"SELECT 1 FROM {table} WHERE id = ? LIMIT 1",
-                               (id_,)
-                               )
-    return cursor.fetchone() is not None
-
+from app.common import (execute_with_normalization, get_db_connection, get_postgres_connection, copy_query, ROLE_REGISTRY,
+                        BatchWriter, get_deferred_foreign_keys, defer_references, load_ids)
+from .bibliography_types import load_bibliography_types
 
 def migrate_person_role():
     conn, cursor = get_db_connection()
     pg_conn, pg_cursor = get_postgres_connection()
 
-    pg_cursor.execute("""
-        SELECT
-            br.iddocument,
-            br.idperson,
-            br.idrole,
-            COALESCE(
-                a.type::text, bp.type::text, b.type::text,
-                bc.type::text, os.type::text, p.type::text, bv.type::text
-            ) AS bib_type
-        FROM data.bibrole br
-        LEFT JOIN (SELECT identity,'article' type FROM data.article) a
-            ON br.iddocument = a.identity
-        LEFT JOIN (SELECT identity,'blog_post' type FROM data.blog_post) bp
-            ON br.iddocument = bp.identity
-        LEFT JOIN (SELECT identity,'book' type FROM data.book) b
-            ON br.iddocument = b.identity
-        LEFT JOIN (SELECT identity,'book_chapter' type FROM data.bookchapter) bc
-            ON br.iddocument = bc.identity
-        LEFT JOIN (SELECT identity,'online_source' type FROM data.online_source) os
-            ON br.iddocument = os.identity
-        LEFT JOIN (SELECT identity,'phd' type FROM data.phd) p
-            ON br.iddocument = p.identity
-        LEFT JOIN (SELECT identity,'bib_varia' type FROM data.bib_varia) bv
-            ON br.iddocument = bv.identity
-    """)
+    biblio_types = load_bibliography_types()
+    check_references = not get_deferred_foreign_keys()
+    if not check_references:
+        for bib_type_enum in set(biblio_types.values()):
+            defer_references(f"{bib_type_enum.value}_person_role", "person")
+    person_ids = load_ids(cursor, "person") if check_references else None
 
-    rows = pg_cursor.fetchall()
-
-    for doc_id, person_id, role_id, bib_type in rows:
-        if not bib_type:
-            continue
+    batches = copy_query(pg_conn, """
+        SELECT iddocument, idperson, idrole
+        FROM data.bibrole
+    """)
+    rows = (row for batch in batches for row in batch)
 
-        bib_type_enum = next(
-            (
-                bt for bt in BiblioType
-                if bt.value == bib_type.lower().replace(" ", "_")
-            ),
-            None
-        )
+    writer = BatchWriter(cursor)
+    execute_with_normalization(cursor, "BEGIN")
 
+    for doc_id, person_id, role_id in rows:
+        bib_type_enum = biblio_types.get(str(doc_id))
         if not bib_type_enum:
             continue
 
         bib_id = str(doc_id)
         person_id = str(person_id)
+        ROLE_REGISTRY.ensure_role_id(cursor, role_id)
         role_id = str(role_id)
 
-        exists = cursor.execute(
-            "SELECT 1 FROM person WHERE id = ?", (person_id,)
-        ).fetchone()
-        if not exists:
+        if check_references and person_id not in person_ids:
             continue
 
-        try:
-            execute_with_normalization(cursor,
-                f"""
-                INSERT INTO {bib_type_enum.value}_person_role
-                    (bibliography_id, person_id, role_id)
-                VALUES (?, ?, ?)
-                """,
-                                       (bib_id, person_id, role_id)
-                                       )
-        except sqlite3.IntegrityError as e:
-            print(
-                "FK ERROR:",
-                bib_type_enum.value,
-                bib_id,
-                person_id,
-                role_id,
-                e
-            )
-
-        execute_with_normalization(cursor,
+        writer.add(
             f"""
             INSERT OR IGNORE INTO {bib_type_enum.value}_person_role
                 (bibliography_id, person_id, role_id)
             VALUES (?, ?, ?)
             """,
-                                   (str(doc_id), str(person_id), str(role_id)))
+            (bib_id, person_id, role_id)
+        )
 
+    writer.flush()
     conn.commit()
     conn.close()
     pg_conn.close()
@@ -1,14 +1,43 @@
 import uuid
 
 from app.common import (execute_with_normalization,
-                        get_db_connection, get_es_client, scroll_all, get_dbbe_indices,
+                        get_db_connection, get_es_client, get_dbbe_indices,
                         add_column_if_missing, get_or_create_role, ROLE_FIELD_TO_ROLE_NAME, insert_many_to_many, insert_many_to_one,
-                        get_postgres_connection, get_public_release
+                        get_postgres_connection, get_public_release, REGION_TREE, BatchWriter, get_db_writer,
+                        get_deferred_foreign_keys, set_foreign_keys, defer_references, load_ids
                         )
+from app.extraction import iter_index_pages, count_private_documents
+
+class IdentificationRegistry:
+    """Identification ids already in SQLite, so a resumed run reuses them instead of adding duplicates."""
+
+    def __init__(self, cursor):
+        # identification has no unique key, so ids are assigned here rather than by SQLite
+        self.ids = {
+            (ident_type, identifier_value): ident_id
+            for ident_id, ident_type, identifier_value in cursor.execute(
+                "SELECT id, type, identifier_value FROM identification ORDER BY id"
+            ).fetchall()
+        }
+        self.next_id = max(self.ids.values(), default=0) + 1
+
+    def get_or_add(self, writer, ident_type, identifier):
+        key = (ident_type, str(identifier))
+        ident_id = self.ids.get(key)
+        if ident_id is None:
+            ident_id = self.ids[key] = self.next_id
+            self.next_id += 1
+            writer.add(
+                "INSERT OR IGNORE INTO identification (id, type, identifier_value) VALUES (?, ?, ?)",
+                (ident_id, ident_type, identifier)
+            )
+        return ident_id
+
 
-def get_library_for_manuscript(pg_cursor, manuscript_id):
+def prefetch_manuscript_libraries(pg_cursor):
     pg_cursor.execute("""
         SELECT DISTINCT
+            la.iddocument AS manuscript_id,
             i.identity AS library_id,
             i.name AS library_name,
             i.idregion AS location_id
@@ -16,12 +45,30 @@ def get_library_for_manuscript(pg_cursor, manuscript_id):
         JOIN data.location l ON la.idlocation = l.idlocation
         JOIN data.fund f ON l.idfund = f.idfund
         JOIN data.institution i ON f.idlibrary = i.identity
-        WHERE la.iddocument = %s
-    """, (manuscript_id,))
-    return pg_cursor.fetchone()
+    """)
+    libraries = {}
+    for manuscript_id, library_id, library_name, location_id in pg_cursor.fetchall():
+        libraries.setdefault(int(manuscript_id), (library_id, library_name, location_id))
+    return libraries
+
+def prefetch_manuscript_origins(pg_cursor):
+    pg_cursor.execute("""
+        SELECT f.subject_identity, l.idregion
+        FROM data.factoid f
+        JOIN data.factoid_type ft
+            ON f.idfactoid_type = ft.idfactoid_type
+        JOIN data.location l
+            ON l.idlocation = f.idlocation
+        WHERE ft.type = 'written'
+          AND l.idregion IS NOT NULL
+    """)
+    origins = {}
+    for manuscript_id, idregion in pg_cursor.fetchall():
+        origins.setdefault(int(manuscript_id), []).append(idregion)
+    return origins
 
-def insert_library(cursor, library_id, name, location_id):
-    execute_with_normalization(cursor, """
+def insert_library(writer, library_id, name, location_id):
+    writer.add("""
         INSERT OR IGNORE INTO library (id, name, location_id)
         VALUES (?, ?, ?)
     """, (int(library_id), name, int(location_id) if location_id else None))
@@ -40,61 +87,12 @@ def create_manuscript_tables(cursor):
     for col, col_type in manuscript_columns:
         add_column_if_missing(cursor, "manuscript", col, col_type)
 
-def get_region_hierarchy(pg_cursor, location_id):
-    hierarchy = []
-    current_id = location_id
-    while current_id:
-        pg_cursor.execute("""
-            SELECT identity, name, historical_name, parent_idregion
-            FROM data.region
-            WHERE identity = %s
-        """, (current_id,))
-        row = pg_cursor.fetchone()
-        if not row:
-            break
-        identity, name, historical_name, parent_id = row
-        hierarchy.append((int(identity), name, historical_name, int(parent_id) if parent_id else None))
-        current_id = parent_id
-    return hierarchy[::-1]
-
-def insert_location_hierarchy(cursor, hierarchy):
-    leaf_id = None
-    for location_id, name, historical_name, parent_id in hierarchy:
-        execute_with_normalization(cursor, """
-            INSERT OR IGNORE INTO location (id, name, historical_name, parent_id)
-            VALUES (?, ?, ?, ?)
-        """, (location_id, name, historical_name, parent_id))
-        leaf_id = location_id
-    return leaf_id
-
-def link_manuscript_to_location(cursor, manuscript_id, pg_cursor):
-    pg_cursor.execute("""
-        SELECT f.idlocation
-        FROM data.factoid f
-        JOIN data.factoid_type ft
-            ON f.idfactoid_type = ft.idfactoid_type
-        WHERE f.subject_identity = %s
-          AND ft.type = 'written'
-    """, (manuscript_id,))
-    loc_rows = pg_cursor.fetchall()
-
-    for (idlocation,) in loc_rows:
-        pg_cursor.execute("""
-            SELECT idregion
-            FROM data.location
-            WHERE idlocation = %s
-        """, (idlocation,))
-        row = pg_cursor.fetchone()
-        if not row:
-            continue
-        idregion = row[0]
-
-        hierarchy = get_region_hierarchy(pg_cursor, idregion)
-
-        leaf_id = insert_location_hierarchy(cursor, hierarchy)
+def link_manuscript_to_location(writer, manuscript_id, origin_region_ids, pg_cursor):
+    for idregion in origin_region_ids:
+        leaf_id = REGION_TREE.insert_location(writer, pg_cursor, idregion)
 
         if leaf_id:
-            execute_with_normalization(cursor, """
+            writer.add("""
                 INSERT OR IGNORE INTO manuscript_location(manuscript_id, origin_id)
                 VALUES (?, ?)
             """, (manuscript_id, leaf_id))
@@ -103,7 +101,7 @@ def migrate_manuscript_content():
     conn, cursor = get_db_connection()
     pg_conn, pg_cursor = get_postgres_connection()
 
-    execute_with_normalization(cursor, "PRAGMA foreign_keys = OFF")
+    set_foreign_keys(cursor, False)
     print("Foreign key constraints disabled for content migration")
 
     pg_cursor.execute("""
@@ -114,231 +112,237 @@ def migrate_manuscript_content():
 
     rows = pg_cursor.fetchall()
     print(f"Fetched {len(rows)} content nodes from Postgres (is_content=True)")
+    content_parents = {
+        int(idgenre): int(idparentgenre) if idparentgenre is not None else None
+        for idgenre, idparentgenre, _ in rows
+    }
 
+    writer = BatchWriter(cursor)
     execute_with_normalization(cursor, "BEGIN")
 
     for idgenre, _, genre in rows:
-        execute_with_normalization(cursor, """
+        writer.add("""
             INSERT OR IGNORE INTO content (id, name)
             VALUES (?, ?)
         """, (int(idgenre), genre))
 
     for idgenre, idparentgenre, _ in rows:
         if idparentgenre is not None:
-            execute_with_normalization(cursor, """
+            writer.add("""
                 UPDATE content
                 SET parent_id = ?
                 WHERE id = ?
             """, (int(idparentgenre), int(idgenre)))
 
+    writer.flush()
     execute_with_normalization(cursor, "COMMIT")
-    execute_with_normalization(cursor, "PRAGMA foreign_keys = ON")
+    set_foreign_keys(cursor, True)
     print("Foreign key constraints re-enabled")
 
     conn.close()
     pg_conn.close()
     print("Content migration completed")
+    return content_parents
 
-def get_deepest_leaf_from_postgres(pg_cursor, content_ids):
+def get_deepest_leaf(content_parents, content_ids):
     if not content_ids:
         return []
 
     content_ids = [int(cid) for cid in content_ids]
 
-    pg_cursor.execute(f"""
-        SELECT idgenre, idparentgenre
-        FROM data.genre
-        WHERE idgenre IN %s
-          AND is_content = TRUE
-    """, (tuple(content_ids),))
-    rows = pg_cursor.fetchall()
-
-    parents_in_list = set(row[1] for row in rows if row[1] is not None)
+    parents_in_list = set(
+        content_parents[cid] for cid in content_ids
+        if content_parents.get(cid) is not None
+    )
 
-    leaf_ids = [int(cid) for cid in content_ids if cid not in parents_in_list]
+    leaf_ids = [cid for cid in content_ids if cid not in parents_in_list]
 
     return leaf_ids
 
 def run_manuscript_migration():
-    migrate_manuscript_content()
+    content_parents = migrate_manuscript_content()
     es = get_es_client()
     conn, cursor = get_db_connection()
     pg_conn, pg_cursor = get_postgres_connection()
+    try:
+        create_manuscript_tables(cursor)
 
-    create_manuscript_tables(cursor)
+        indices = get_dbbe_indices(es)
+        manuscript_index = next((idx for idx in indices if idx.endswith("manuscripts")), None)
 
-    indices = get_dbbe_indices(es)
-    manuscript_index = next((idx for idx in indices if idx.endswith("manuscripts")), None)
-    
-    if not manuscript_index:
-        print("No manuscript index found")
-        conn.close()
-        return
-    
-    print(f"Migrating manuscripts from index: {manuscript_index}")
-    hits = scroll_all(es, manuscript_index)
-    print(f"Total manuscripts fetched: {len(hits)}")
-    
-    execute_with_normalization(cursor, "BEGIN")
-    
-    for hit in hits:
-        source = hit['_source']
-        manuscript_id = int(source.get('id', hit['_id']))
+        if not manuscript_index:
+            print("No manuscript index found")
+            return
 
-        is_public_manuscript = bool(source.get('public', False))
+        print(f"Migrating manuscripts from index: {manuscript_index}")
         is_public_release = get_public_release()
+        if is_public_release:
+            print(f"Filtered out {count_private_documents(es, manuscript_index)} private manuscripts in Elasticsearch")
+
+        libraries = prefetch_manuscript_libraries(pg_cursor)
+        origins = prefetch_manuscript_origins(pg_cursor)
+        REGION_TREE.ensure_loaded(pg_cursor)
+
+        check_references = not get_deferred_foreign_keys()
+        if not check_references:
+            defer_references("manuscript_person_role", "person")
+        person_ids = load_ids(cursor, "person") if check_references else None
+        identifications = IdentificationRegistry(cursor)
+        # Roles are created up front; once the writer thread runs it is the connection's only writer
+        role_ids = {
+            role_field: get_or_create_role(cursor, role_name_in_table)
+            for role_field, role_name_in_table in ROLE_FIELD_TO_ROLE_NAME.items()
+        }
+        writer = get_db_writer(conn, cursor)
+        manuscript_count = 0
 
-        if not is_public_manuscript and is_public_release:
-            print(f"Skipping type {manuscript_id} because public=False during public release")
-            continue
-
-        private_comment_val = None
-        if not is_public_release:
-            private_comment_val = source.get('private_comment')
-
-        execute_with_normalization(cursor, """
-        INSERT INTO manuscript (
-            id, name, completion_date_floor, completion_date_ceiling,
-            created, modified, public_comment, private_comment, number_of_occurrences, shelf
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(id) DO UPDATE SET
-            name = excluded.name,
-            completion_date_floor = excluded.completion_date_floor,
-            completion_date_ceiling = excluded.completion_date_ceiling,
-            created = excluded.created,
-            modified = excluded.modified,
-            public_comment = excluded.public_comment,
-            private_comment=excluded.private_comment,
-            number_of_occurrences = excluded.number_of_occurrences,
-            shelf = excluded.shelf
-        """, (
-            manuscript_id,
-            source.get('name'),
-            source.get('completion_floor'),
-            source.get('completion_ceiling'),
-            source.get('created'),
-            source.get('modified'),
-            source.get('public_comment'),
-            private_comment_val,
-            source.get('number_of_occurrences'),
-            source.get('shelf')
-        ))
-
-        for role_field, role_name_in_table in ROLE_FIELD_TO_ROLE_NAME.items():
-            role_id = get_or_create_role(cursor, role_name_in_table)
-            if not role_id:
-                continue
-
-            persons = source.get(role_field, [])
-            if isinstance(persons, dict):
-                persons = [persons]
-            elif not isinstance(persons, list):
-                persons = []
-
-            for p in persons:
-                person_id = str(p.get('id', ''))
-                if not person_id:
-                    continue
-
-                exists = cursor.execute(
-                    "SELECT 1 FROM person WHERE id = ?", (person_id,)
-                ).fetchone()
-                if not exists:
-                    continue  # skip if person doesn't exist
-
-                execute_with_normalization(
-                    cursor,
-                    "INSERT INTO manuscript_person_role (manuscript_id, person_id, role_id) VALUES (?, ?, ?)",
-                    (manuscript_id, person_id, role_id)
-                )
-
-        link_manuscript_to_location(cursor, manuscript_id, pg_cursor)
-
-        MANUSCRIPT_M2M = [
-            {
-                "source_key": "management",
-                "entity_table": "management",
-                "join_table": "manuscript_management",
-                "parent_id_col": "manuscript_id",
-                "entity_id_col": "management_id",
-            },
-            {
-                "source_key": "acknowledgement",
-                "entity_table": "acknowledgement",
-                "join_table": "manuscript_acknowledgement",
-                "parent_id_col": "manuscript_id",
-                "entity_id_col": "acknowledgement_id",
-            },
-        ]
-
-        for cfg in MANUSCRIPT_M2M:
-            insert_many_to_many(
-                cursor=cursor,
-                source=source,
-                parent_id=manuscript_id,
-                **cfg,
-            )
-
-        insert_many_to_one(cursor, "collection", "collection", manuscript_id, source.get("collection"))
-
-        lib = get_library_for_manuscript(pg_cursor, manuscript_id)
-
-        if lib:
-            library_id, library_name, location_id = lib
-
-            if location_id:
-                hierarchy = get_region_hierarchy(pg_cursor, location_id)
-                insert_location_hierarchy(cursor, hierarchy)
-
-            insert_library(cursor, library_id, library_name, location_id)
-            execute_with_normalization(cursor, """
-                UPDATE manuscript
-                SET library_id = ?
-                WHERE id = ?
-            """, (int(library_id), manuscript_id))
+        for hits in iter_index_pages(es, manuscript_index, resumable=True, public_only=is_public_release,
+                                     before_checkpoint=writer.sync):
+            for hit in hits:
+                source = hit['_source']
+                manuscript_id = int(source.get('id', hit['_id']))
 
+                is_public_manuscript = bool(source.get('public', False))
 
+                if not is_public_manuscript and is_public_release:
+                    print(f"Skipping type {manuscript_id} because public=False during public release")
+                    continue
 
-        MANUSCRIPT_IDENT_TYPE_MAP = {
-            "diktyon": "diktyon"
-        }
+                private_comment_val = None
+                if not is_public_release:
+                    private_comment_val = source.get('private_comment')
 
-        content_list = source.get("content", [])
-        content_ids = [c.get("id") for c in content_list if c.get("id")]
+                writer.add("""
+                INSERT INTO manuscript (
+                    id, name, completion_date_floor, completion_date_ceiling,
+                    created, modified, public_comment, private_comment, number_of_occurrences, shelf
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    name = excluded.name,
+                    completion_date_floor = excluded.completion_date_floor,
+                    completion_date_ceiling = excluded.completion_date_ceiling,
+                    created = excluded.created,
+                    modified = excluded.modified,
+                    public_comment = excluded.public_comment,
+                    private_comment=excluded.private_comment,
+                    number_of_occurrences = excluded.number_of_occurrences,
+                    shelf = excluded.shelf
+                """, (
+                    manuscript_id,
+                    source.get('name'),
+                    source.get('completion_floor'),
+                    source.get('completion_ceiling'),
+                    source.get('created'),
+                    source.get('modified'),
+                    source.get('public_comment'),
+                    private_comment_val,
+                    source.get('number_of_occurrences'),
+                    source.get('shelf')
+                ))
+
+                for role_field, role_id in role_ids.items():
+                    if not role_id:
+                        continue
+
+                    persons = source.get(role_field, [])
+                    if isinstance(persons, dict):
+                        persons = [persons]
+                    elif not isinstance(persons, list):
+                        persons = []
+
+                    for p in persons:
+                        person_id = str(p.get('id', ''))
+                        if not person_id:
+                            continue
+
+                        if check_references and person_id not in person_ids:
+                            continue  # skip if person doesn't exist
+
+                        writer.add(
+                            "INSERT OR IGNORE INTO manuscript_person_role (manuscript_id, person_id, role_id) VALUES (?, ?, ?)",
+                            (manuscript_id, person_id, role_id)
+                        )
 
-        leaf_ids = get_deepest_leaf_from_postgres(pg_cursor, content_ids)
+                link_manuscript_to_location(writer, manuscript_id, origins.get(manuscript_id, []), pg_cursor)
+
+                MANUSCRIPT_M2M = [
+                    {
+                        "source_key": "management",
+                        "entity_table": "management",
+                        "join_table": "manuscript_management",
+                        "parent_id_col": "manuscript_id",
+                        "entity_id_col": "management_id",
+                    },
+                    {
+                        "source_key": "acknowledgement",
+                        "entity_table": "acknowledgement",
+                        "join_table": "manuscript_acknowledgement",
+                        "parent_id_col": "manuscript_id",
+                        "entity_id_col": "acknowledgement_id",
+                    },
+                ]
+
+                for cfg in MANUSCRIPT_M2M:
+                    insert_many_to_many(
+                        writer=writer,
+                        source=source,
+                        parent_id=manuscript_id,
+                        **cfg,
+                    )
+
+                insert_many_to_one(writer, "collection", "collection", manuscript_id, source.get("collection"))
+
+                lib = libraries.get(manuscript_id)
+
+                if lib:
+                    library_id, library_name, location_id = lib
+
+                    if location_id:
+                        REGION_TREE.insert_location(writer, pg_cursor, location_id)
+
+                    insert_library(writer, library_id, library_name, location_id)
+                    writer.add("""
+                        UPDATE manuscript
+                        SET library_id = ?
+                        WHERE id = ?
+                    """, (int(library_id), manuscript_id))
+
+
+
+                MANUSCRIPT_IDENT_TYPE_MAP = {
+                    "diktyon": "diktyon"
+                }
+
+                content_list = source.get("content", [])
+                content_ids = [c.get("id") for c in content_list if c.get("id")]
+
+                leaf_ids = get_deepest_leaf(content_parents, content_ids)
+
+                for leaf_id in leaf_ids:
+                    writer.add("""
+                        INSERT OR IGNORE INTO manuscript_content (manuscript_id, content_id)
+                        VALUES (?, ?)
+                    """, (manuscript_id, leaf_id))
+
+                for es_field, ident_type in MANUSCRIPT_IDENT_TYPE_MAP.items():
+                    for identifier in source.get(es_field, []):
+                        if not identifier:
+                            continue
+                        ident_id = identifications.get_or_add(writer, ident_type, identifier)
+                        writer.add(
+                            "INSERT OR IGNORE INTO manuscript_identification (manuscript_id, identification_id) VALUES (?, ?)",
+                            (manuscript_id, ident_id)
+                        )
 
-        for leaf_id in leaf_ids:
-            execute_with_normalization(cursor, """
-                INSERT OR IGNORE INTO manuscript_content (manuscript_id, content_id)
-                VALUES (?, ?)
-            """, (manuscript_id, leaf_id))
+                manuscript_count += 1
 
-        for es_field, ident_type in MANUSCRIPT_IDENT_TYPE_MAP.items():
-            for identifier in source.get(es_field, []):
-                if not identifier:
-                    continue
-                execute_with_normalization(cursor,
-                    "INSERT OR IGNORE INTO identification (type, identifier_value) VALUES (?, ?)",
-                                           (ident_type, identifier)
-                                           )
-                ident_id = cursor.lastrowid
-                if ident_id == 0:
-                    execute_with_normalization(cursor,
-                        "SELECT id FROM identification WHERE type = ? AND identifier_value = ?",
-                                               (ident_type, identifier)
-                                               )
-                    ident_id = cursor.fetchone()[0]
-                execute_with_normalization(cursor,
-                    "INSERT OR IGNORE INTO manuscript_identification (manuscript_id, identification_id) VALUES (?, ?)",
-                                           (manuscript_id, ident_id)
-                                           )
+        writer.close()
 
-    execute_with_normalization(cursor, "COMMIT")
-    conn.close()
-    
-    print(f"Manuscripts migration completed: {len(hits)} manuscripts inserted")
+        print(f"Manuscripts migration completed: {manuscript_count} manuscripts inserted")
+    finally:
+        pg_conn.close()
+        conn.close()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,24 @@
-from app.common import (execute_with_normalization,
-                        get_db_connection, get_es_client, scroll_all, get_dbbe_indices,
+from app.common import (get_db_connection, get_es_client, get_dbbe_indices,
                         get_role_id, ROLE_FIELD_TO_ROLE_NAME, get_public_release,
-                        insert_many_to_many, get_postgres_connection
+                        insert_many_to_many, get_postgres_connection, preload_subject_keywords,
+                        stream_query, get_db_writer, set_foreign_keys
                         )
-
-def preload_related_occurrence(pg_cursor):
-    pg_cursor.execute("""
+from app.extraction import iter_index_pages, iter_private_ids
+
+OCCURRENCE_TABLES_TO_CLEAN = [
+    "verses",
+    "occurrence_keyword",
+    "occurrence_genre",
+    "occurrence_metre",
+    "occurrence_acknowledgement",
+    "occurrence_management",
+    "occurrence_person_role",
+    "occurrence_text_status",
+    "occurrence_related_occurrence",
+]
+
+def preload_related_occurrence(pg_conn):
+    rows = stream_query(pg_conn, """
         WITH verse_links AS (
             SELECT
                 a.idoriginal_poem AS src,
@@ -32,243 +45,220 @@ def preload_related_occurrence(pg_cursor):
     """)
 
     rel = {}
-    for src, dst in pg_cursor.fetchall():
+    for src, dst in rows:
         rel.setdefault(str(src), []).append(str(dst))
     return rel
 
 
-def get_subject_keyword(pg_cursor, subject_id):
-    pg_cursor.execute("""
-        SELECT identity, keyword
-        FROM data.keyword
-        WHERE identity = %s
-          AND is_subject = true
-    """, (subject_id,))
-    return pg_cursor.fetchone()
+def remove_occurrences(writer, occ_ids):
+    rows = [(occ_id,) for occ_id in occ_ids]
+    if not rows:
+        return
+    for table in OCCURRENCE_TABLES_TO_CLEAN:
+        writer.add_many(f"DELETE FROM {table} WHERE occurrence_id = ?", rows)
+    writer.add_many("DELETE FROM occurrence WHERE id = ?", rows)
 
 
 def run_occurrence_migration():
     es = get_es_client()
     conn, cursor = get_db_connection()
     pg_conn, pg_cursor = get_postgres_connection()
-    related_occurrence_map = preload_related_occurrence(pg_cursor)
+    try:
+        related_occurrence_map = preload_related_occurrence(pg_conn)
 
-    execute_with_normalization(cursor, "PRAGMA foreign_keys = OFF")
-    print("Foreign key constraints disabled for migration")
+        set_foreign_keys(cursor, False)
+        print("Foreign key constraints disabled for migration")
 
-    indices = get_dbbe_indices(es)
-    occ_index = next((idx for idx in indices if idx.endswith("occurrences")), None)
+        indices = get_dbbe_indices(es)
+        occ_index = next((idx for idx in indices if idx.endswith("occurrences")), None)
 
-    if not occ_index:
-        print("No occurrence index found")
-        execute_with_normalization(cursor, "PRAGMA foreign_keys = ON")
-        conn.close()
-        return
+        if not occ_index:
+            print("No occurrence index found")
+            set_foreign_keys(cursor, True)
+            return
 
-    print(f"Migrating occurrence from index: {occ_index}")
-    hits = scroll_all(es, occ_index, size=500)
-    print(f"Total occurrence fetched: {len(hits)}")
+        print(f"Migrating occurrence from index: {occ_index}")
 
-    execute_with_normalization(cursor, "BEGIN")
-    batch_count = 0
+        keyword_cache = preload_subject_keywords(pg_cursor)
 
-    pg_cursor.execute("""
-        SELECT identity, keyword
-        FROM data.keyword
-        WHERE is_subject = true
-    """)
-    keyword_cache = {str(row[0]): row[1] for row in pg_cursor.fetchall()}
+        is_public_release = get_public_release()
 
-    for hit in hits:
-        source = hit['_source']
-        manuscript_id = str(source.get('manuscript', {}).get('id', ''))
+        batch_count = 0
+        role_ids = {
+            role_field: get_role_id(cursor, role_name_in_table)
+            for role_field, role_name_in_table in ROLE_FIELD_TO_ROLE_NAME.items()
+        }
+
+        writer = get_db_writer(conn, cursor)
+
+        if is_public_release:
+            # Private occurrences are filtered out in Elasticsearch, but the verse step already created stubs for them
+            private_ids = list(iter_private_ids(es, occ_index))
+            remove_occurrences(writer, private_ids)
+            print(f"Filtered out {len(private_ids)} private occurrences in Elasticsearch")
+
+        for hits in iter_index_pages(es, occ_index, size=500, resumable=True, public_only=is_public_release,
+                                     before_checkpoint=writer.sync):
+            for hit in hits:
+                source = hit['_source']
+                manuscript_id = str(source.get('manuscript', {}).get('id', ''))
+
+                occ_id = str(source.get('id', hit['_id']))
+                is_public_occurrence = bool(source.get('public', False))
+
+                if not is_public_occurrence and is_public_release:
+                    print(f"Skipping occurrence {occ_id} because public=False during public release")
+                    remove_occurrences(writer, [occ_id])
+                    continue
+
+                private_comment_val = None
+                if not is_public_release:
+                    private_comment_val = source.get('private_comment')
+
+                writer.add("""
+                    INSERT OR IGNORE INTO occurrence (id)
+                    VALUES (?)
+                """, (occ_id,))
+
+                writer.add("""
+                UPDATE occurrence SET
+                    created=?, modified=?, public_comment=?, private_comment=?,
+                    is_dbbe=?, incipit=?, text_stemmer=?, text_original=?,
+                    location_in_ms=?, completion_date_floor=?, completion_date_ceiling=?,
+                    palaeographical_info=?, contextual_info=?, manuscript_id=?, title=?
+                WHERE id=?
+                """, (
+                    source.get('created', ''),
+                    source.get('modified', ''),
+                    source.get('public_comment', ''),
+                    private_comment_val,
+                    bool(source.get('dbbe', False)),
+                    source.get('incipit', ''),
+                    source.get('text_stemmer', ''),
+                    source.get('text_original', ''),
+                    source.get('location', ''),
+                    source.get('completion_floor', ''),
+                    source.get('completion_ceiling', ''),
+                    source.get('palaeographical_info', ''),
+                    source.get('contextual_info', ''),
+                    manuscript_id,
+                    source.get('title_original', ''),
+                    occ_id
+                ))
+
+                subjects = source.get("subject", [])
+                if isinstance(subjects, dict):
+                    subjects = [subjects]
+                elif not isinstance(subjects, list):
+                    subjects = []
+
+                occ_keyword_rows = []
+                for subj in subjects:
+                    subject_id = str(subj.get("id", ""))
+                    if not subject_id:
+                        continue
+
+                    keyword_name = keyword_cache.get(subject_id)
+                    if not keyword_name:
+                        continue
+                    writer.add(
+                        "INSERT OR IGNORE INTO keyword (id, name) VALUES (?, ?)",
+                        (subject_id, keyword_name)
+                    )
+                    occ_keyword_rows.append((occ_id, subject_id))
+
+                writer.add_many(
+                    "INSERT OR IGNORE INTO occurrence_keyword (occurrence_id, keyword_id) VALUES (?, ?)",
+                    occ_keyword_rows
+                )
+
+                OCCURRENCE_M2M = [
+                    {
+                        "source_key": "genre",
+                        "entity_table": "genre",
+                        "join_table": "occurrence_genre",
+                        "parent_id_col": "occurrence_id",
+                        "entity_id_col": "genre_id",
+                    },
+                    {
+                        "source_key": "metre",
+                        "entity_table": "metre",
+                        "join_table": "occurrence_metre",
+                        "parent_id_col": "occurrence_id",
+                        "entity_id_col": "metre_id",
+                    },
+                    {
+                        "source_key": "acknowledgement",
+                        "entity_table": "acknowledgement",
+                        "join_table": "occurrence_acknowledgement",
+                        "parent_id_col": "occurrence_id",
+                        "entity_id_col": "acknowledgement_id",
+                    },
+                    {
+                        "source_key": "management",
+                        "entity_table": "management",
+                        "join_table": "occurrence_management",
+                        "parent_id_col": "occurrence_id",
+                        "entity_id_col": "management_id",
+                    },
+                ]
+
+                for cfg in OCCURRENCE_M2M:
+                    insert_many_to_many(
+                        writer=writer,
+                        source=source,
+                        parent_id=occ_id,
+                        **cfg
+                    )
+
+                ts = source.get('text_status')
+                if isinstance(ts, dict):
+                    ts_id = str(ts.get('id', ''))
+                    ts_name = ts.get('name', '')
+                    if ts_id:
+                        writer.add(
+                            "INSERT OR IGNORE INTO text_status (id, name) VALUES (?, ?)",
+                            (ts_id, ts_name)
+                        )
+                        writer.add(
+                            "INSERT OR IGNORE INTO occurrence_text_status (occurrence_id, text_status_id) VALUES (?, ?)",
+                            (occ_id, ts_id)
+                        )
 
-        source = hit['_source']
-        occ_id = str(source.get('id', hit['_id']))
-        is_public_occurrence = bool(source.get('public', False))
-        is_public_release = get_public_release()
+                for role_field, role_id in role_ids.items():
+                    if not role_id:
+                        continue
 
-        if not is_public_occurrence and is_public_release:
-            print(f"Skipping occurrence {occ_id} because public=False during public release")
-
-            tables_to_clean = [
-                "verses",
-                "occurrence_keyword",
-                "occurrence_genre",
-                "occurrence_metre",
-                "occurrence_acknowledgement",
-                "occurrence_management",
-                "occurrence_person_role",
-                "occurrence_text_status",
-                "occurrence_related_occurrence",
-            ]
-
-            for table in tables_to_clean:
-                execute_with_normalization(cursor,
-                                           f"DELETE FROM {table} WHERE occurrence_id = ?",
-                                           (occ_id,))
-            execute_with_normalization(cursor,
-                                       "DELETE FROM occurrence WHERE id = ?",
-                                       (occ_id,))
-
-            execute_with_normalization(cursor, "COMMIT")
-            execute_with_normalization(cursor, "BEGIN")
-            continue
-
-        private_comment_val = None
-        if not is_public_release:
-            private_comment_val = source.get('private_comment')
-
-        execute_with_normalization(cursor, """
-            INSERT OR IGNORE INTO occurrence (id)
-            VALUES (?)
-        """, (occ_id,))
-
-        execute_with_normalization(cursor, """
-        UPDATE occurrence SET
-            created=?, modified=?, public_comment=?, private_comment=?,
-            is_dbbe=?, incipit=?, text_stemmer=?, text_original=?,
-            location_in_ms=?, completion_date_floor=?, completion_date_ceiling=?,
-            palaeographical_info=?, contextual_info=?, manuscript_id=?, title=?
-        WHERE id=?
-        """, (
-            source.get('created', ''),
-            source.get('modified', ''),
-            source.get('public_comment', ''),
-            private_comment_val,
-            bool(source.get('dbbe', False)),
-            source.get('incipit', ''),
-            source.get('text_stemmer', ''),
-            source.get('text_original', ''),
-            source.get('location', ''),
-            source.get('completion_floor', ''),
-            source.get('completion_ceiling', ''),
-            source.get('palaeographical_info', ''),
-            source.get('contextual_info', ''),
-            manuscript_id,
-            source.get('title_original', ''),
-            occ_id
-        ))
-
-        subjects = source.get("subject", [])
-        if isinstance(subjects, dict):
-            subjects = [subjects]
-        elif not isinstance(subjects, list):
-            subjects = []
-
-        occ_keyword_rows = []
-        for subj in subjects:
-            subject_id = str(subj.get("id", ""))
-            if not subject_id:
-                continue
-
-            keyword_name = keyword_cache.get(subject_id)
-            if not keyword_name:
-                continue
-            execute_with_normalization(cursor,
-                "INSERT OR IGNORE INTO keyword (id, name) VALUES (?, ?)",
-                                       (subject_id, keyword_name)
-                                       )
-            occ_keyword_rows.append((occ_id, subject_id))
-
-        if occ_keyword_rows:
-            cursor.executemany(
-                "INSERT OR IGNORE INTO occurrence_keyword (occurrence_id, keyword_id) VALUES (?, ?)",
-                occ_keyword_rows
-            )
-
-        OCCURRENCE_M2M = [
-            {
-                "source_key": "genre",
-                "entity_table": "genre",
-                "join_table": "occurrence_genre",
-                "parent_id_col": "occurrence_id",
-                "entity_id_col": "genre_id",
-            },
-            {
-                "source_key": "metre",
-                "entity_table": "metre",
-                "join_table": "occurrence_metre",
-                "parent_id_col": "occurrence_id",
-                "entity_id_col": "metre_id",
-            },
-            {
-                "source_key": "acknowledgement",
-                "entity_table": "acknowledgement",
-                "join_table": "occurrence_acknowledgement",
-                "parent_id_col": "occurrence_id",
-                "entity_id_col": "acknowledgement_id",
-            },
-            {
-                "source_key": "management",
-                "entity_table": "management",
-                "join_table": "occurrence_management",
-                "parent_id_col": "occurrence_id",
-                "entity_id_col": "management_id",
-            },
-        ]
-
-        for cfg in OCCURRENCE_M2M:
-            insert_many_to_many(
-                cursor=cursor,
-                source=source,
-                parent_id=occ_id,
-                **cfg
-            )
-
-        ts = source.get('text_status')
-        if isinstance(ts, dict):
-            ts_id = str(ts.get('id', ''))
-            ts_name = ts.get('name', '')
-            if ts_id:
-                execute_with_normalization(cursor,
-                    "INSERT OR IGNORE INTO text_status (id, name) VALUES (?, ?)",
-                                           (ts_id, ts_name)
-                                           )
-                execute_with_normalization(cursor,
-                    "INSERT OR IGNORE INTO occurrence_text_status (occurrence_id, text_status_id) VALUES (?, ?)",
-                                           (occ_id, ts_id))
-
-        for role_field, role_name_in_table in ROLE_FIELD_TO_ROLE_NAME.items():
-            role_id = get_role_id(cursor, role_name_in_table)
-            if not role_id:
-                continue
-
-            person = source.get(role_field, [])
-            if isinstance(person, dict):
-                person = [person]
-            elif not isinstance(person, list):
-                person = []
-
-            for p in person:
-                person_id = str(p.get('id', ''))
-                if person_id:
-                    execute_with_normalization(cursor,
-                        "INSERT OR IGNORE INTO occurrence_person_role (occurrence_id, person_id, role_id) VALUES (?, ?, ?)",
-                                               (occ_id, person_id, role_id)
-                                               )
-
-
-        related_ids = related_occurrence_map.get(occ_id, [])
-        if related_ids:
-            related_rows = [(occ_id, rid, '0') for rid in related_ids]
-            cursor.executemany("""
-                INSERT OR IGNORE INTO occurrence_related_occurrence
-                (occurrence_id, related_occurrence_id, relation_definition_id)
-                VALUES (?, ?, ?)
-            """, related_rows)
-
-        batch_count += 1
-        if batch_count % 1000 == 0:
-            execute_with_normalization(cursor, "COMMIT")
-            execute_with_normalization(cursor, "BEGIN")
-            print(f"Processed {batch_count} occurrences...")
-
-    execute_with_normalization(cursor, "COMMIT")
-
-    execute_with_normalization(cursor, "PRAGMA foreign_keys = ON")
-    print("Foreign key constraints re-enabled")
-
-    conn.close()
-
-    print(f"Occurrences migration completed: {batch_count} occurrences updated")
+                    person = source.get(role_field, [])
+                    if isinstance(person, dict):
+                        person = [person]
+                    elif not isinstance(person, list):
+                        person = []
+
+                    for p in person:
+                        person_id = str(p.get('id', ''))
+                        if person_id:
+                            writer.add(
+                                "INSERT OR IGNORE INTO occurrence_person_role (occurrence_id, person_id, role_id) VALUES (?, ?, ?)",
+                                (occ_id, person_id, role_id)
+                            )
+
+
+                related_ids = related_occurrence_map.get(occ_id, [])
+                writer.add_many("""
+                    INSERT OR IGNORE INTO occurrence_related_occurrence
+                    (occurrence_id, related_occurrence_id, relation_definition_id)
+                    VALUES (?, ?, ?)
+                """, [(occ_id, rid, '0') for rid in related_ids])
+
+                batch_count += 1
+
+        writer.close()
+
+        set_foreign_keys(cursor, True)
+        print("Foreign key constraints re-enabled")
+
+        print(f"Occurrences migration completed: {batch_count} occurrences updated")
+    finally:
+        pg_conn.close()
+        conn.close()
@@ -1,6 +1,7 @@
 
 import uuid
-from app.common import execute_with_normalization, get_db_connection, get_postgres_connection, get_es_client, get_dbbe_indices,scroll_all, get_public_release
+from app.common import get_db_connection, get_postgres_connection, get_es_client, get_dbbe_indices, get_public_release, REGION_TREE, stream_query, get_db_writer
+from app.extraction import iter_index_pages
 
 def parse_fuzzy_date(fd):
     if not fd:
@@ -17,31 +18,6 @@ def parse_fuzzy_date(fd):
     return floor, ceiling
 
 
-def get_location_hierarchy_and_leaf(cursor, pg_cursor, location_id):
-    hierarchy = []
-    current_id = location_id
-    while current_id:
-        pg_cursor.execute("""
-            SELECT identity, name, historical_name, parent_idregion
-            FROM data.region
-            WHERE identity = %s
-        """, (current_id,))
-        row = pg_cursor.fetchone()
-        if not row:
-            break
-        identity, name, historical_name, parent_id = row
-        hierarchy.append((str(identity), name, historical_name, str(parent_id) if parent_id else None))
-        current_id = parent_id
-
-    leaf_id = None
-    for loc_id, name, hist_name, parent_id in reversed(hierarchy):
-        execute_with_normalization(cursor, """
-            INSERT OR IGNORE INTO location (id, name, historical_name, parent_id)
-            VALUES (?, ?, ?, ?)
-        """, (loc_id, name, hist_name, parent_id))
-        leaf_id = loc_id
-    return leaf_id
-
 def get_person_public_statuses():
     es = get_es_client()
     indices = get_dbbe_indices(es)
@@ -50,21 +26,44 @@ def get_person_public_statuses():
         print("No person index found")
         return
 
-    es_hits = scroll_all(es, person_index, size=500)
-
     es_person_visibility = {
         str(hit['_id']): bool(hit['_source'].get('public', False))
-        for hit in es_hits
+        for hits in iter_index_pages(es, person_index, size=500)
+        for hit in hits
     }
 
     return es_person_visibility
 
 
+def load_person_links(pg_cursor, table, link_column):
+    pg_cursor.execute(f"""
+        SELECT idperson, {link_column}
+        FROM data.{table}
+    """)
+    links = {}
+    for person_id, link_id in pg_cursor.fetchall():
+        links.setdefault(str(person_id), []).append(str(link_id))
+    return links
+
+
 def run_person_migration():
     conn, cursor = get_db_connection()
     pg_conn, pg_cursor = get_postgres_connection()
 
     pg_cursor.execute("""
+        SELECT idlocation, idregion
+        FROM data.location
+        WHERE idregion IS NOT NULL
+    """)
+    region_by_location = dict(pg_cursor.fetchall())
+
+    self_designations = load_person_links(pg_cursor, "person_self_designation", "idself_designation")
+    offices = load_person_links(pg_cursor, "person_occupation", "idoccupation")
+    self_designation_rows = []
+    office_rows = []
+
+    person_public_statuses = get_person_public_statuses()
+    person_query = """
         SELECT
             person.identity,
             name.first_name,
@@ -109,21 +108,22 @@ def run_person_migration():
             WHERE ft.type = 'origination'
         ) AS factoid_orig
             ON person.identity = factoid_orig.subject_identity
+    """
+
+    pg_cursor.execute(f"""
+        SELECT identity
+        FROM ({person_query}) AS persons
+        WHERE idlocation IS NOT NULL
+        GROUP BY identity
+        HAVING COUNT(*) > 1
+        LIMIT 1
     """)
+    duplicate = pg_cursor.fetchone()
+    if duplicate:
+        raise ValueError(f"Person {duplicate[0]} has multiple origination location in Postgres!")
 
-    rows = pg_cursor.fetchall()
-
-    person_location = {}
-    for row in rows:
-        pid = str(row[0])
-        loc_id = row[4]
-        if loc_id:
-            if pid in person_location:
-                raise ValueError(f"Person {pid} has multiple origination location in Postgres!")
-            person_location[pid] = loc_id
-
-    person_public_statuses = get_person_public_statuses()
-    execute_with_normalization(cursor, "BEGIN")
+    rows = stream_query(pg_conn, person_query)
+    writer = get_db_writer(conn, cursor)
 
     for row in rows:
         (
@@ -158,7 +158,7 @@ def run_person_migration():
         born_floor, born_ceiling = parse_fuzzy_date(born_date)
         death_floor, death_ceiling = parse_fuzzy_date(death_date)
 
-        execute_with_normalization(cursor, """
+        writer.add("""
         INSERT INTO person (
             id, first_name, last_name,
             born_date_floor, born_date_ceiling,
@@ -199,43 +199,32 @@ def run_person_migration():
         ))
 
         if orig_location_id:
-            pg_cursor.execute("""
-                SELECT idregion
-                FROM data.location
-                WHERE idlocation = %s
-            """, (orig_location_id,))
-            row_region = pg_cursor.fetchone()
-            if row_region and row_region[0]:
-                region_id = row_region[0]
-                leaf_id = get_location_hierarchy_and_leaf(cursor, pg_cursor, region_id)
-                execute_with_normalization(cursor, """
+            region_id = region_by_location.get(orig_location_id)
+            if region_id:
+                leaf_id = REGION_TREE.insert_location(writer, pg_cursor, region_id)
+                leaf_id = str(leaf_id) if leaf_id else None
+                writer.add("""
                     UPDATE person
                     SET location_id = ?
                     WHERE id = ?
                 """, (leaf_id, person_id))
 
-        pg_cursor.execute("""
-            SELECT idself_designation
-            FROM data.person_self_designation
-            WHERE idperson = %s
-        """, (person_id,))
-        for (sd_id,) in pg_cursor.fetchall():
-            execute_with_normalization(cursor, """
-                INSERT OR IGNORE INTO person_self_designation (person_id, self_designation_id)
-                VALUES (?, ?)
-            """, (person_id, str(sd_id)))
-
-        pg_cursor.execute("""
-            SELECT idoccupation
-            FROM data.person_occupation
-            WHERE idperson = %s
-        """, (person_id,))
-        for (office_id,) in pg_cursor.fetchall():
-            execute_with_normalization(cursor, """
-                INSERT OR IGNORE INTO person_office (person_id, office_id)
-                VALUES (?, ?)
-            """, (person_id, str(office_id)))
-
-    execute_with_normalization(cursor, "COMMIT")
+        self_designation_rows.extend(
+            (person_id, sd_id) for sd_id in self_designations.get(person_id, [])
+        )
+        office_rows.extend(
+            (person_id, office_id) for office_id in offices.get(person_id, [])
+        )
+
+    writer.add_many("""
+        INSERT OR IGNORE INTO person_self_designation (person_id, self_designation_id)
+        VALUES (?, ?)
+    """, self_designation_rows)
+    writer.add_many("""
+        INSERT OR IGNORE INTO person_office (person_id, office_id)
+        VALUES (?, ?)
+    """, office_rows)
+
+    writer.close()
     conn.close()
     pg_conn.close()
@@ -1,5 +1,5 @@
 # app/migrate_bibliographies/schema.py
-from app.common import execute_with_normalization, get_db_connection, add_column_if_missing, get_postgres_connection
+from app.common import execute_with_normalization, get_db_connection, add_column_if_missing, get_postgres_connection, copy_into_sqlite
 
 def create_schema():
     conn, cursor = get_db_connection()
@@ -76,19 +76,16 @@ def create_schema():
     )
     """)
 
-    pg_cursor.execute("SELECT id, name FROM data.self_designation")
-    for sd_id, sd_name in pg_cursor.fetchall():
-        execute_with_normalization(cursor, """
-            INSERT OR IGNORE INTO self_designation (id, name)
-            VALUES (?, ?)
-        """, (str(sd_id), sd_name))
+    copy_into_sqlite(pg_conn, "SELECT id, name FROM data.self_designation", cursor, """
+        INSERT OR IGNORE INTO self_designation (id, name)
+        VALUES (?, ?)
+    """)
 
-    pg_cursor.execute("SELECT idoccupation, occupation FROM data.occupation")
-    for office_id, office_name in pg_cursor.fetchall():
-        execute_with_normalization(cursor, """
-            INSERT OR IGNORE INTO office (id, name)
-            VALUES (?, ?)
-        """, (str(office_id), office_name))
+    copy_into_sqlite(pg_conn, "SELECT idoccupation, occupation FROM data.occupation", cursor, """
+        INSERT OR IGNORE INTO office (id, name)
+        VALUES (?, ?)
+    """)
 
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+    pg_conn.close()
\ No newline at end of file
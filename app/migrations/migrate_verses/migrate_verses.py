@@ -1,6 +1,7 @@
-from app.common import (execute_with_normalization,
-                        get_db_connection, get_es_client, scroll_all, get_dbbe_indices, add_column_if_missing, execute_with_normalization
+from app.common import (get_db_connection, get_es_client, get_dbbe_indices, add_column_if_missing, get_db_writer,
+                        set_foreign_keys
                         )
+from app.extraction import iter_index_pages
 
 def create_verse_tables(cursor):
 
@@ -18,7 +19,7 @@ def migrate_verses():
     conn, cursor = get_db_connection()
     create_verse_tables(cursor)
 
-    execute_with_normalization(cursor, "PRAGMA foreign_keys = ON;")
+    set_foreign_keys(cursor, True)
 
     indices = get_dbbe_indices(es)
     verse_index = next((idx for idx in indices if idx.endswith("verses")), None)
@@ -29,54 +30,50 @@ def migrate_verses():
         return
 
     print(f"Migrating verses from index: {verse_index}")
-    hits = scroll_all(es, verse_index)
-    print(f"Total verses fetched: {len(hits)}")
 
-    execute_with_normalization(cursor, "BEGIN TRANSACTION")
+    writer = get_db_writer(conn, cursor)
     batch_count = 0
 
-    for hit in hits:
-        source = hit["_source"]
-        try:
-            verse_id = int(source.get("id", hit["_id"]))
-        except (TypeError, ValueError):
-            continue
-
-        text = source.get("verse", "")
-        order_in_occurrence = source.get("order", 0)
-
-        occurrence_id = source.get("occurrence", {}).get("id")
-        if occurrence_id is not None:
+    for hits in iter_index_pages(es, verse_index, resumable=True, before_checkpoint=writer.sync):
+        for hit in hits:
+            source = hit["_source"]
             try:
-                occurrence_id = int(occurrence_id)
+                verse_id = int(source.get("id", hit["_id"]))
             except (TypeError, ValueError):
-                occurrence_id = None
-
-        if occurrence_id is not None:
-            execute_with_normalization(cursor,
-                "INSERT OR IGNORE INTO occurrence (id) VALUES (?)",
-                                       (occurrence_id,)
-                                       )
-
-        verse_group_id = source.get("group_id")
-        if verse_group_id is not None:
-            try:
-                verse_group_id = int(verse_group_id)
-            except (TypeError, ValueError):
-                verse_group_id = None
-
-        execute_with_normalization(cursor, """
-            INSERT OR IGNORE INTO verses (
-                id, text, occurrence_id, order_in_occurrence, verse_group_id
-            ) VALUES (?, ?, ?, ?, ?)
-        """, (verse_id, text, occurrence_id, order_in_occurrence, verse_group_id))
-
-        batch_count += 1
-        if batch_count % 1000 == 0:
-            execute_with_normalization(cursor, "COMMIT")
-            execute_with_normalization(cursor, "BEGIN TRANSACTION")
-
-    execute_with_normalization(cursor, "COMMIT")
+                continue
+
+            text = source.get("verse", "")
+            order_in_occurrence = source.get("order", 0)
+
+            occurrence_id = source.get("occurrence", {}).get("id")
+            if occurrence_id is not None:
+                try:
+                    occurrence_id = int(occurrence_id)
+                except (TypeError, ValueError):
+                    occurrence_id = None
+
+            if occurrence_id is not None:
+                writer.add(
+                    "INSERT OR IGNORE INTO occurrence (id) VALUES (?)",
+                    (occurrence_id,)
+                )
+
+            verse_group_id = source.get("group_id")
+            if verse_group_id is not None:
+                try:
+                    verse_group_id = int(verse_group_id)
+                except (TypeError, ValueError):
+                    verse_group_id = None
+
+            writer.add("""
+                INSERT OR IGNORE INTO verses (
+                    id, text, occurrence_id, order_in_occurrence, verse_group_id
+                ) VALUES (?, ?, ?, ?, ?)
+            """, (verse_id, text, occurrence_id, order_in_occurrence, verse_group_id))
+
+            batch_count += 1
+
+    writer.close()
     conn.close()
     print(f"Verse migration completed: {batch_count} verses inserted")
 
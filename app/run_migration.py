@@ -6,14 +6,13 @@ from app.migrations.migrate_types import migrate_types
 from app.migrations.migrate_occurrences import migrate_occurrences
 from app.migrations.migrate_manuscripts import migrate_manuscripts
 from app.migrations.migrate_bibliographies import migrate_bibliographies
+from app.migrations.migrate_bibliographies.bibliography_titles import prefetch_bibliography_titles
 from .zenodo_upload import upload_sqlite_files_to_zenodo
-from .common import NORMALIZATION_STATS
+from .common import NORMALIZATION_STATS, close_postgres_pool, finalize_database, get_bool_env, publish_database
+from .extraction import clear_checkpoints, get_extraction_mode, reset_stale_checkpoints
+from .async_extraction import close_async_extractor
 import os
 
-def str_to_bool(value: str) -> bool:
-    return value.lower() in {"1", "true", "yes", "on"}
-
-
 def run_migration():
     steps = [
         ("Initializing database", create_base_tables),
@@ -23,9 +22,17 @@ def run_migration():
         ("Migrating occurrence", migrate_occurrences),
         ("Migrating type", migrate_types),
         ("Migrating bibliographies", migrate_bibliographies),
+        ("Finalizing database", finalize_database),
+        ("Publishing database", publish_database),
 
     ]
 
+    reset_stale_checkpoints()
+
+    if get_extraction_mode() == "async":
+        # The bibliography titles stream in concurrently with the earlier steps
+        prefetch_bibliography_titles()
+
     for i, (step_name, step_func) in enumerate(steps, 1):
         try:
             step_func()
@@ -35,6 +42,10 @@ def run_migration():
             print(f"Migration failed at step {i}")
             sys.exit(1)
 
+    close_async_extractor()
+    close_postgres_pool()
+    clear_checkpoints()
+
 
 if __name__ == "__main__":
     run_migration()
@@ -45,13 +56,11 @@ if __name__ == "__main__":
         for original, normalized in NORMALIZATION_STATS["samples"]:
             print(f"'{original}' → '{normalized}'")
 
-    enable_zenodo_upload = str_to_bool(
-        os.getenv("ENABLE_ZENODO_UPLOAD", "false")
-    )
+    enable_zenodo_upload = get_bool_env("ENABLE_ZENODO_UPLOAD", False)
 
     if enable_zenodo_upload:
         BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        publish_draft=str_to_bool(os.getenv("PUBLISH_DRAFT", "false"))
+        publish_draft=get_bool_env("PUBLISH_DRAFT", False)
         deposition_id=os.getenv("DEPOSITION_ID", None)
         data_folder = os.path.join(BASE_DIR, 'data')
         upload_sqlite_files_to_zenodo(data_folder,publish_draft,deposition_id)
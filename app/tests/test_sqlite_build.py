@@ -0,0 +1,107 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("elasticsearch")
+
+from app.common import BatchWriter, DEFERRED_REFERENCES, SQLiteWriter, check_foreign_keys, defer_references, parse_copy_field
+from app.migrations.migrate_manuscripts.insert_manuscripts import IdentificationRegistry
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    return conn, conn.cursor()
+
+
+def test_batch_writer_keeps_insert_order(tmp_path):
+    conn, cursor = connect(tmp_path / "order.sqlite")
+    cursor.execute("PRAGMA foreign_keys = ON")
+    cursor.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+    cursor.execute("CREATE TABLE child (id INTEGER PRIMARY KEY, parent_id INTEGER REFERENCES parent(id))")
+
+    writer = BatchWriter(cursor, batch_size=100)
+    for i in range(1, 4):
+        writer.add("INSERT INTO parent (id) VALUES (?)", (i,))
+        writer.add("INSERT INTO child (id, parent_id) VALUES (?, ?)", (i, i))
+    writer.add("DELETE FROM child WHERE id = ?", (2,))
+    writer.add("INSERT INTO child (id, parent_id) VALUES (?, ?)", (2, 3))
+    writer.close()
+
+    assert cursor.execute("SELECT id, parent_id FROM child ORDER BY id").fetchall() == [(1, 1), (2, 3), (3, 3)]
+    conn.close()
+
+
+def test_sqlite_writer_raises_batch_errors(tmp_path):
+    conn, cursor = connect(tmp_path / "errors.sqlite")
+    cursor.execute("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+
+    writer = BatchWriter(cursor, batch_size=100, sink=SQLiteWriter(conn))
+    writer.add("INSERT INTO item (id) VALUES (?)", (1,))
+    writer.add("INSERT INTO missing (id) VALUES (?)", (1,))
+    with pytest.raises(sqlite3.OperationalError):
+        writer.sync()
+    with pytest.raises(sqlite3.OperationalError):
+        writer.add("INSERT INTO item (id) VALUES (?)", (2,))
+        writer.flush()
+    with pytest.raises(sqlite3.OperationalError):
+        writer.close()
+    conn.close()
+
+
+@pytest.mark.parametrize("field, value", [
+    ("\\N", None),
+    ("plain", "plain"),
+    ("a\\tb\\nc", "a\tb\nc"),
+    ("back\\\\slash", "back\\slash"),
+    ("\\x41\\101", "AA"),
+    ("", ""),
+])
+def test_parse_copy_field(field, value):
+    assert parse_copy_field(field) == value
+
+
+def test_check_foreign_keys_prunes_deferred_references_only(tmp_path, monkeypatch):
+    monkeypatch.setenv("SQLITE_DEFERRED_FOREIGN_KEYS", "true")
+    monkeypatch.setenv("SQLITE_FK_VIOLATIONS", "prune")
+    monkeypatch.setattr("app.common.DEFERRED_REFERENCES", set(DEFERRED_REFERENCES))
+    db_path = tmp_path / "fk.sqlite"
+    conn, cursor = connect(db_path)
+    cursor.execute("CREATE TABLE person (id TEXT PRIMARY KEY)")
+    cursor.execute("CREATE TABLE deferred_link (person_id TEXT REFERENCES person(id))")
+    cursor.execute("CREATE TABLE checked_link (person_id TEXT REFERENCES person(id))")
+    cursor.execute("INSERT INTO person (id) VALUES ('1')")
+    cursor.executemany("INSERT INTO deferred_link (person_id) VALUES (?)", [("1",), ("2",)])
+    cursor.executemany("INSERT INTO checked_link (person_id) VALUES (?)", [("1",), ("2",)])
+    conn.close()
+
+    defer_references("deferred_link", "person")
+    check_foreign_keys(db_path)
+
+    conn, cursor = connect(db_path)
+    assert cursor.execute("SELECT person_id FROM deferred_link").fetchall() == [("1",)]
+    assert cursor.execute("SELECT person_id FROM checked_link ORDER BY person_id").fetchall() == [("1",), ("2",)]
+    conn.close()
+
+
+def test_identification_ids_are_reused_on_replay(tmp_path):
+    conn, cursor = connect(tmp_path / "identification.sqlite")
+    cursor.execute("CREATE TABLE identification (id INTEGER PRIMARY KEY, type TEXT NOT NULL, identifier_value TEXT NOT NULL)")
+    cursor.execute("INSERT INTO identification (id, type, identifier_value) VALUES (5, 'diktyon', '100')")
+
+    first_ids = []
+    for _ in range(2):
+        writer = BatchWriter(cursor, batch_size=100)
+        identifications = IdentificationRegistry(cursor)
+        ids = [
+            identifications.get_or_add(writer, "diktyon", 100),
+            identifications.get_or_add(writer, "diktyon", "200"),
+            identifications.get_or_add(writer, "rgk", "200"),
+        ]
+        writer.close()
+        first_ids = first_ids or ids
+        assert ids == first_ids
+
+    assert first_ids == [5, 6, 7]
+    assert cursor.execute("SELECT COUNT(*) FROM identification").fetchone()[0] == 3
+    conn.close()